@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import re
+import time
+
+from server import sanitize_html
+
+
+def legacy_sanitize_html(value):
+    if not value:
+        return ""
+    cleaned = re.sub(r"(?is)<script[^>]*>.*?</script>", "", value)
+    cleaned = re.sub(r"(?is)<base[^>]*>", "", cleaned)
+    cleaned = re.sub(r"(?is)on\w+\s*=\s*(['\"]).*?\1", "", cleaned)
+    cleaned = re.sub(r"(?is)javascript:", "", cleaned)
+    return cleaned
+
+
+def newsletter(size):
+    row = (
+        '<tr><td style="padding:12px;font-family:Arial" class="item">'
+        '<a href="https://example.com/p?id=1&amp;ref=mail" onclick="track(1)">'
+        '<img src="https://cdn.example.com/a.png" width="120" alt="Item"></a>'
+        "<p>Limited offer &mdash; save 20% on everything this week only.</p></td></tr>\n"
+    )
+    body = row * max(1, size // len(row))
+    return f"<html><head><base href=\"https://example.com/\"></head><body><table>{body}</table></body></html>"
+
+
+def unclosed_handlers(size):
+    return '<div onmouseover="' + "x" * size
+
+
+def repeated_on(size):
+    return "on" * max(1, size // 2)
+
+
+def unclosed_scripts(size):
+    return "<script>" * max(1, size // 8)
+
+
+def unclosed_tags(size):
+    return "<a " * max(1, size // 3)
+
+
+def unclosed_attrs(size):
+    return '<a x="' * max(1, size // 6)
+
+
+def unclosed_comments(size):
+    return "<!--" * max(1, size // 4)
+
+
+CASES = {
+    "newsletter": newsletter,
+    "unclosed-handlers": unclosed_handlers,
+    "repeated-on": repeated_on,
+    "unclosed-scripts": unclosed_scripts,
+    "unclosed-tags": unclosed_tags,
+    "unclosed-attrs": unclosed_attrs,
+    "unclosed-comments": unclosed_comments,
+}
+
+
+def best_of(func, value, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(value)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sanitize_html against the old regex chain")
+    parser.add_argument(
+        "--sizes",
+        default="10000,40000,160000",
+        help="Comma-separated input sizes in characters",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--case",
+        action="append",
+        choices=sorted(CASES),
+        help="Only run these cases (default: all)",
+    )
+    parser.add_argument(
+        "--skip-legacy",
+        action="store_true",
+        help="Do not time the old regex chain (it is quadratic on adversarial input)",
+    )
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    print(f"{'case':<18} {'size':>9} {'legacy ms':>11} {'parser ms':>11} {'speedup':>9}")
+    for name in args.case or sorted(CASES):
+        for size in sizes:
+            value = CASES[name](size)
+            current = best_of(sanitize_html, value, args.repeat)
+            if args.skip_legacy:
+                print(f"{name:<18} {len(value):>9} {'-':>11} {current * 1000:>11.1f} {'-':>9}")
+                continue
+            legacy = best_of(legacy_sanitize_html, value, args.repeat)
+            speedup = legacy / current if current else 0
+            print(
+                f"{name:<18} {len(value):>9} {legacy * 1000:>11.1f} "
+                f"{current * 1000:>11.1f} {speedup:>8.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,44 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import base64
+import calendar
 import email
+import hashlib
+import heapq
 import html
 import imaplib
+import itertools
+import json
 import os
+import queue
+import quopri
+import random
 import re
 import secrets
+import selectors
 import socket
 import sqlite3
+import ssl
 import string
 import sys
 import threading
 import time
 import webbrowser
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
 from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+from urllib.parse import quote
 
 import requests
 from flask import (
     Flask,
+    Response,
     abort,
     flash,
     jsonify,
@@ -60,9 +79,65 @@ DB_PATH = "mailadmin.db"
 IMAP_HOST = os.environ.get("MAILADMIN_IMAP_HOST", "outlook.live.com")
 DEFAULT_LIMIT = 10
 MAX_LIMIT = 50
+SHARE_LIST_COLUMNS = "code, subject, mail_from, mail_to, mail_dt, owner_key, created_at"
 SHARE_CODE_LEN = 8
+SHARE_PAGE_SIZE = 50
+SHARE_PAGE_MAX = 200
 MULTI_USER = os.environ.get("MAILADMIN_MULTI_USER", "0") == "1"
 API_KEY_COOKIE = "api_key"
+IMAP_POOL_SIZE = int(os.environ.get("MAILADMIN_IMAP_POOL_SIZE", "20"))
+IMAP_POOL_IDLE = int(os.environ.get("MAILADMIN_IMAP_POOL_IDLE", "300"))
+IMAP_POOL_WAIT = 30
+IMAP_TIMEOUT = float(os.environ.get("MAILADMIN_IMAP_TIMEOUT", "30"))
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_CACHE_PERSIST = os.environ.get("MAILADMIN_TOKEN_CACHE_PERSIST", "0") == "1"
+SANITIZE_CACHE_BYTES = int(os.environ.get("MAILADMIN_SANITIZE_CACHE_BYTES", str(32 * 1024 * 1024)))
+LIST_ENGINE = os.environ.get("MAILADMIN_LIST_ENGINE", "headers")
+LIST_PARALLEL = os.environ.get("MAILADMIN_LIST_PARALLEL", "1") == "1"
+FOLDER_WORKERS = int(os.environ.get("MAILADMIN_FOLDER_WORKERS", "4"))
+STORE_BODIES = os.environ.get("MAILADMIN_STORE_BODIES", "1") == "1"
+SYNC_INTERVAL = int(os.environ.get("MAILADMIN_SYNC_INTERVAL", "120"))
+SYNC_WORKERS = int(os.environ.get("MAILADMIN_SYNC_WORKERS", "4"))
+SYNC_JITTER = 0.1
+PART_CHUNK = int(os.environ.get("MAILADMIN_PART_CHUNK", str(1024 * 1024)))
+AGGREGATE_WORKERS = int(os.environ.get("MAILADMIN_AGGREGATE_WORKERS", "8"))
+AGGREGATE_TIMEOUT = float(os.environ.get("MAILADMIN_AGGREGATE_TIMEOUT", "10"))
+SYNC_DEPTH = 50
+WAIT_DEFAULT_TIMEOUT = 60
+WAIT_MAX_TIMEOUT = 120
+WAIT_POLL_INTERVAL = 5
+WAIT_LOOKBACK = 60
+WAIT_PATTERN_MAX = 200
+IDLE_ENABLED = os.environ.get("MAILADMIN_IDLE", "0") == "1"
+IDLE_CONNECT_WORKERS = int(os.environ.get("MAILADMIN_IDLE_CONNECT_WORKERS", "8"))
+IDLE_RENEW = 29 * 60
+IDLE_RECONNECT_MAX = 300
+IDLE_RECONCILE = 60
+EVENT_HISTORY = 2000
+EVENT_KEEPALIVE = 15
+STREAM_BUFFER = 256
+IDLE_EXISTS_RE = re.compile(rb"^\* (\d+) EXISTS")
+IDLE_EXPUNGE_RE = re.compile(rb"^\* (\d+) EXPUNGE")
+SYNC_WINDOW = 500
+FOLDER_CACHE_TTL = int(os.environ.get("MAILADMIN_FOLDER_TTL", "86400"))
+FOLDER_LIST_RE = re.compile(rb'^\((?P<flags>[^)]*)\) (?P<delim>"(?:[^"\\]|\\.)*"|NIL) (?P<name>.+)$')
+LIST_HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO DATE)]"
+FETCH_SIZE_RE = re.compile(rb"\bRFC822\.SIZE (\d+)")
+FETCH_FLAGS_RE = re.compile(rb"\bFLAGS \(([^)]*)\)")
+STATUS_ITEM_RE = re.compile(rb"\b(MESSAGES|UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)")
+FETCH_START_RE = re.compile(rb"^(\d+) \(")
+FETCH_UID_RE = re.compile(rb"\bUID (\d+)")
+FETCH_LITERAL_RE = re.compile(
+    rb"((?:BODY|BINARY)\[[^\]]*\](?:<\d+>)?|RFC822(?:\.HEADER|\.TEXT)?) \{\d+\}$",
+    re.IGNORECASE,
+)
+SAFE_ATTR_RE = re.compile(r"^[a-z_:][-a-z0-9_:.]*$")
+SCRIPT_URL_RE = re.compile(r"(?i)(?:javascript|vbscript):")
+SECTION_RE = re.compile(r"^\d+(?:\.\d+)*$")
+NESTED_QUANTIFIER_RE = re.compile(r"\([^()]*[+*}][^()]*\)\s*[+*{]")
+CID_IMG_RE = re.compile(r"""(?i)(<img\b[^>]*?\bsrc\s*=\s*)(["'])cid:([^"']+)\2""")
+INLINE_IMAGE_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+IMAP_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}\s*$|[^\s()"]+')
 JUNK_FOLDERS = [
     "junk",
     "Junk",
@@ -371,12 +446,17 @@ BASE_TEMPLATE = """
           <div class="brand">Mail<span>Admin</span></div>
           <div class="tagline">Multi-mailbox control with HTML previews and share links.</div>
         </div>
-        <div>
+        <div style="display:flex; align-items:center; gap:8px;">
+          <form method="get" action="{{ url_for('search_page') }}" style="display:flex; gap:8px;">
+            <input type="search" name="q" placeholder="Search mail" value="{{ search_query or '' }}">
+            <button class="btn secondary small" type="submit">Search</button>
+          </form>
           <a class="btn ghost" href="{{ url_for('index') }}">Home</a>
         </div>
       </div>
       <div class="nav">
         <a class="{{ 'active' if active == 'mailboxes' else '' }}" href="{{ url_for('index') }}">Mailboxes</a>
+        <a class="{{ 'active' if active == 'all' else '' }}" href="{{ url_for('all_mail_page') }}">All mail</a>
         <a class="{{ 'active' if active == 'import' else '' }}" href="{{ url_for('import_page') }}">Import</a>
         <a class="{{ 'active' if active == 'shares' else '' }}" href="{{ url_for('shares_page') }}">Recent shares</a>
         <a class="{{ 'active' if active == 'account' else '' }}" href="{{ url_for('account_page') }}">Account</a>
@@ -412,6 +492,62 @@ BASE_TEMPLATE = """
       }
     })();
   </script>
+  <script>
+    (function () {
+      var view = document.querySelector("[data-live-mailbox]");
+      if (!view || !window.EventSource) {
+        return;
+      }
+      var address = view.getAttribute("data-live-mailbox");
+      var status = document.querySelector("[data-sync-status]");
+      var source = new EventSource("{{ url_for('api_events') }}");
+      source.addEventListener("message", function (event) {
+        var data = JSON.parse(event.data);
+        var msg = data.message;
+        if (data.address !== address || !msg) {
+          return;
+        }
+        var key = msg.folder + ":" + msg.uid;
+        if (view.querySelector('[data-key="' + CSS.escape(key) + '"]')) {
+          return;
+        }
+        var list = view.querySelector(".message-list");
+        if (!list) {
+          view.innerHTML = "";
+          list = document.createElement("div");
+          list.className = "message-list";
+          view.appendChild(list);
+        }
+        var item = document.createElement("a");
+        item.className = "message-item";
+        item.setAttribute("data-key", key);
+        item.href = view.getAttribute("data-message-url").replace("__UID__", encodeURIComponent(msg.uid)) + "?folder=" + encodeURIComponent(msg.folder);
+        var body = document.createElement("div");
+        var subject = document.createElement("div");
+        subject.className = "message-subject";
+        subject.textContent = msg.subject || "(No subject)";
+        var meta = document.createElement("div");
+        meta.className = "message-meta";
+        meta.textContent = msg.mail_from + " | " + msg.mail_dt + " | " + msg.folder_label;
+        var action = document.createElement("div");
+        action.className = "message-meta";
+        action.textContent = "New";
+        body.appendChild(subject);
+        body.appendChild(meta);
+        item.appendChild(body);
+        item.appendChild(action);
+        list.insertBefore(item, list.firstChild);
+      });
+      source.addEventListener("sync", function (event) {
+        var data = JSON.parse(event.data);
+        if (data.address !== address || !status) {
+          return;
+        }
+        var when = new Date(data.synced_at * 1000).toLocaleTimeString();
+        status.textContent = data.error ? "| Sync failed: " + data.error : "| Synced " + when;
+      });
+    })();
+  </script>
 </body>
 </html>
 """
@@ -485,6 +621,11 @@ SHARES_TEMPLATE = """
         </div>
       </div>
     {% endfor %}
+    {% if next_before %}
+      <div class="toolbar" style="margin-top: 12px;">
+        <a class="btn ghost small" href="{{ url_for('shares_page', before=next_before) }}">Older</a>
+      </div>
+    {% endif %}
   {% endif %}
 </div>
 """
@@ -493,7 +634,7 @@ MAILBOX_TEMPLATE = """
 <div class="card">
   <div class="section-title">
     <h2>{{ mailbox['address'] }}</h2>
-    <span class="mailbox-meta">Showing {{ messages|length }} message(s) | Inbox + Junk</span>
+    <span class="mailbox-meta">Showing {{ messages|length }} message(s) | Inbox + Junk <span data-sync-status></span></span>
   </div>
   <form method="get" class="toolbar">
     <div style="display:flex; align-items:center; gap:8px;">
@@ -504,7 +645,7 @@ MAILBOX_TEMPLATE = """
     <a class="btn ghost small" href="{{ url_for('index') }}">Back</a>
   </form>
 </div>
-<div class="card" style="margin-top: 16px;">
+<div class="card" style="margin-top: 16px;"{% if live %} data-live-mailbox="{{ mailbox['address'] }}" data-message-url="{{ url_for('view_message', address=mailbox['address'], uid='__UID__') }}"{% endif %}>
   {% if error %}
     <p>{{ error }}</p>
   {% elif not messages %}
@@ -512,7 +653,7 @@ MAILBOX_TEMPLATE = """
   {% else %}
     <div class="message-list">
       {% for msg in messages %}
-      <a class="message-item" href="{{ url_for('view_message', address=mailbox['address'], uid=msg['uid'], folder=msg['folder']) }}">
+      <a class="message-item" data-key="{{ msg['folder'] }}:{{ msg['uid'] }}" href="{{ url_for('view_message', address=mailbox['address'], uid=msg['uid'], folder=msg['folder']) }}">
         <div>
           <div class="message-subject">{{ msg['subject'] or '(No subject)' }}</div>
           <div class="message-meta">{{ msg['mail_from'] }} | {{ msg['mail_dt'] }} | {{ msg['folder_label'] }}</div>
@@ -521,6 +662,89 @@ MAILBOX_TEMPLATE = """
       </a>
       {% endfor %}
     </div>
+    {% if next_cursor %}
+      <div class="toolbar" style="margin-top: 12px;">
+        <a class="btn ghost small" href="{{ url_for('view_mailbox', address=mailbox['address'], limit=limit, cursor=next_cursor) }}">Older</a>
+      </div>
+    {% endif %}
+  {% endif %}
+</div>
+"""
+
+ALL_MAIL_TEMPLATE = """
+<div class="card">
+  <div class="section-title">
+    <h2>All mail</h2>
+    <span class="mailbox-meta">Showing {{ messages|length }} message(s) across {{ mailbox_count }} mailbox(es)</span>
+  </div>
+  <form method="get" class="toolbar">
+    <div style="display:flex; align-items:center; gap:8px;">
+      <label for="limit">Limit</label>
+      <input id="limit" type="number" name="limit" min="1" max="{{ max_limit }}" value="{{ limit }}">
+    </div>
+    <button class="btn secondary small" type="submit">Refresh</button>
+    <a class="btn ghost small" href="{{ url_for('index') }}">Back</a>
+  </form>
+</div>
+<div class="card" style="margin-top: 16px;">
+  {% for err in errors %}
+    <p>{{ err['address'] }}: {{ err['error'] }}</p>
+  {% endfor %}
+  {% if not messages %}
+    <p>No messages found.</p>
+  {% else %}
+    <div class="message-list">
+      {% for msg in messages %}
+      <a class="message-item" href="{{ url_for('view_message', address=msg['address'], uid=msg['uid'], folder=msg['folder']) }}">
+        <div>
+          <div class="message-subject">{{ msg['subject'] or '(No subject)' }}</div>
+          <div class="message-meta">{{ msg['address'] }} | {{ msg['mail_from'] }} | {{ msg['mail_dt'] }} | {{ msg['folder_label'] }}</div>
+        </div>
+        <div class="message-meta">View</div>
+      </a>
+      {% endfor %}
+    </div>
+  {% endif %}
+</div>
+"""
+
+SEARCH_TEMPLATE = """
+<div class="card">
+  <div class="section-title">
+    <h2>Search</h2>
+    <span class="mailbox-meta">{{ results|length }} result(s){% if took_ms is not none %} in {{ took_ms }} ms{% endif %}</span>
+  </div>
+  <form method="get" class="toolbar">
+    <input type="search" name="q" value="{{ search_query }}" placeholder="Subject, sender, recipient or body">
+    <select name="mailbox">
+      <option value="">All mailboxes</option>
+      {% for item in mailboxes %}
+        <option value="{{ item['address'] }}" {{ 'selected' if item['address'] == mailbox else '' }}>{{ item['address'] }}</option>
+      {% endfor %}
+    </select>
+    <button class="btn secondary small" type="submit">Search</button>
+  </form>
+</div>
+<div class="card" style="margin-top: 16px;">
+  {% if error %}
+    <p>{{ error }}</p>
+  {% elif not search_query %}
+    <p>Enter a search term. Only messages already synced to the local store are searched.</p>
+  {% elif not results %}
+    <p>No messages found.</p>
+  {% else %}
+    <div class="message-list">
+      {% for msg in results %}
+      <a class="message-item" href="{{ url_for('view_message', address=msg['address'], uid=msg['uid'], folder=msg['folder']) }}">
+        <div>
+          <div class="message-subject">{{ msg['subject'] or '(No subject)' }}</div>
+          <div class="message-meta">{{ msg['address'] }} | {{ msg['mail_from'] }} | {{ msg['mail_dt'] }} | {{ msg['folder_label'] }}</div>
+          {% if msg['snippet'] %}<div class="message-meta">{{ msg['snippet'] }}</div>{% endif %}
+        </div>
+        <div class="message-meta">View</div>
+      </a>
+      {% endfor %}
+    </div>
   {% endif %}
 </div>
 """
@@ -543,6 +767,14 @@ MESSAGE_TEMPLATE = """
     </form>
     <a class="btn ghost small" href="{{ url_for('view_mailbox', address=mailbox['address']) }}">Back</a>
   </div>
+  {% if message['parts'] %}
+  <div class="mailbox-meta" style="margin-top: 12px;">
+    Attachments:
+    {% for part in message['parts'] %}
+      <a href="{{ url_for('api_get_part', address=mailbox['address'], uid=message['uid'], section=part['section'], folder=message['folder']) }}">{{ part['filename'] or part['content_type'] }}</a> ({{ (part['size'] / 1024) | round(1) }} KB){{ ',' if not loop.last else '' }}
+    {% endfor %}
+  </div>
+  {% endif %}
 </div>
 <div class="card" style="margin-top: 16px;">
   {% if message['safe_body_html'] %}
@@ -743,6 +975,10 @@ class MailError(Exception):
     pass
 
 
+class StreamClosed(Exception):
+    pass
+
+
 def get_db():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
@@ -751,6 +987,7 @@ def get_db():
 
 def init_db():
     with get_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS mailboxes (
@@ -779,6 +1016,16 @@ def init_db():
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS share_bodies (
+                hash TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                refcount INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -788,8 +1035,126 @@ def init_db():
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS oauth_tokens (
+                cache_key TEXT PRIMARY KEY,
+                access_token TEXT NOT NULL,
+                expires_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mailbox_folders (
+                mailbox_id INTEGER PRIMARY KEY,
+                folders TEXT NOT NULL,
+                checked_at INTEGER NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS folder_state (
+                mailbox_id INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                checked_at INTEGER NOT NULL,
+                PRIMARY KEY (mailbox_id, folder)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mailbox_id INTEGER NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                subject TEXT,
+                mail_from TEXT,
+                mail_to TEXT,
+                mail_dt TEXT,
+                mail_ts INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                body_html TEXT,
+                body_text TEXT,
+                has_body INTEGER NOT NULL DEFAULT 0,
+                fetched_at INTEGER NOT NULL,
+                UNIQUE (mailbox_id, folder, uidvalidity, uid)
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_mailbox_ts ON messages (mailbox_id, mail_ts DESC)"
+        )
         ensure_column(conn, "mailboxes", "owner_key", "TEXT NOT NULL DEFAULT ''")
         ensure_column(conn, "shares", "owner_key", "TEXT NOT NULL DEFAULT ''")
+        ensure_column(conn, "shares", "body_hash", "TEXT NOT NULL DEFAULT ''")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_shares_owner_created ON shares (owner_key, created_at, code)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_shares_created ON shares (created_at, code)")
+        ensure_column(conn, "folder_state", "uidnext", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "folder_state", "highestmodseq", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "folder_state", "message_count", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "folder_state", "low_uid", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "folder_state", "synced_at", "INTEGER NOT NULL DEFAULT 0")
+        ensure_column(conn, "messages", "flags", "TEXT NOT NULL DEFAULT ''")
+        parts_column = [row for row in conn.execute("PRAGMA table_info(messages)").fetchall() if row[1] == "parts"]
+        if parts_column and parts_column[0][3]:
+            conn.execute("ALTER TABLE messages DROP COLUMN parts")
+        ensure_column(conn, "messages", "parts", "TEXT")
+        legacy = conn.execute(
+            "SELECT code, body_html FROM shares WHERE body_hash = '' AND body_html IS NOT NULL"
+        ).fetchall()
+        for row in legacy:
+            conn.execute(
+                "UPDATE shares SET body_hash = ?, body_html = NULL WHERE code = ?",
+                (store_share_body(conn, row["body_html"]), row["code"]),
+            )
+        try:
+            backfill = not fts_enabled(conn)
+            conn.execute(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+                    subject, mail_from, mail_to, body, tokenize = 'unicode61 remove_diacritics 2'
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                BEGIN
+                    DELETE FROM messages_fts WHERE rowid = old.id;
+                END
+                """
+            )
+            if backfill:
+                for row in conn.execute(
+                    "SELECT id, subject, mail_from, mail_to, body_text, body_html FROM messages"
+                ).fetchall():
+                    conn.execute(
+                        "INSERT INTO messages_fts (rowid, subject, mail_from, mail_to, body) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            row["id"],
+                            row["subject"] or "",
+                            row["mail_from"] or "",
+                            row["mail_to"] or "",
+                            row["body_text"] or html_to_text(row["body_html"]),
+                        ),
+                    )
+            if not STORE_BODIES:
+                conn.execute("UPDATE messages_fts SET body = '' WHERE body != ''")
+        except sqlite3.OperationalError:
+            pass
+    if legacy:
+        conn = get_db()
+        conn.isolation_level = None
+        conn.execute("VACUUM")
+        conn.close()
 
 
 def ensure_column(conn, table, column, column_type):
@@ -811,11 +1176,14 @@ def render_page(title, template, **context):
         active=active,
         api_key_cookie=API_KEY_COOKIE,
         show_logout=context.get("show_logout", False),
+        search_query=context.get("search_query", ""),
     )
 
 
-def api_ok(data=None, status=200):
+def api_ok(data=None, status=200, meta=None):
     payload = {"ok": True, "data": data}
+    if meta is not None:
+        payload["meta"] = meta
     return jsonify(payload), status
 
 
@@ -824,6 +1192,57 @@ def api_error(message, status=400):
     return jsonify(payload), status
 
 
+def stream_response(produce, sse=False):
+    records = queue.Queue(maxsize=STREAM_BUFFER)
+    stopped = threading.Event()
+
+    def put(record):
+        while not stopped.is_set():
+            try:
+                records.put(record, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise StreamClosed()
+
+    def run():
+        try:
+            try:
+                produce(put)
+            except StreamClosed:
+                raise
+            except MailError as exc:
+                put({"type": "error", "error": str(exc)})
+            except Exception as exc:
+                print(f"Stream failed: {exc.__class__.__name__}: {exc}")
+                put({"type": "error", "error": "Stream failed."})
+            put(None)
+        except StreamClosed:
+            pass
+
+    threading.Thread(target=run, name="stream", daemon=True).start()
+
+    def generate():
+        try:
+            while True:
+                record = records.get()
+                if record is None:
+                    break
+                data = json.dumps(record, ensure_ascii=False)
+                if sse:
+                    yield f"event: {record['type']}\ndata: {data}\n\n"
+                else:
+                    yield data + "\n"
+        finally:
+            stopped.set()
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 def row_to_dict(row):
     if row is None:
         return None
@@ -959,7 +1378,7 @@ def parse_import_payload(payload):
     return results, errors
 
 
-def get_access_token(client_id, refresh_token):
+def request_access_token(client_id, refresh_token):
     url = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
     data = {
         "client_id": client_id,
@@ -984,7 +1403,123 @@ def get_access_token(client_id, refresh_token):
     access_token = payload.get("access_token")
     if not access_token:
         raise MailError("Access token missing.")
-    return access_token
+    try:
+        expires_in = int(payload.get("expires_in") or 3600)
+    except (TypeError, ValueError):
+        expires_in = 3600
+    return access_token, expires_in
+
+
+class TokenCache:
+    def __init__(self, persist):
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, client_id, refresh_token, force=False):
+        key = token_cache_key(client_id, refresh_token)
+        token = None if force else self._lookup(key)
+        if token:
+            return token
+        with self._key_lock(key):
+            token = None if force else self._lookup(key, count=False)
+            if token:
+                return token
+            access_token, expires_in = request_access_token(client_id, refresh_token)
+            expires_at = int(time.time()) + expires_in
+            with self.lock:
+                self.entries[key] = (access_token, expires_at)
+                self.refreshes += 1
+                self._evict_locked(time.time())
+            if self.persist:
+                self._save(key, access_token, expires_at)
+            return access_token
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "refreshes": self.refreshes,
+                "persist": self.persist,
+            }
+
+    def _lookup(self, key, count=True):
+        cutoff = time.time() + TOKEN_REFRESH_MARGIN
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None and self.persist:
+            entry = self._load(key)
+            if entry is not None:
+                with self.lock:
+                    self.entries[key] = entry
+        fresh = entry is not None and entry[1] > cutoff
+        if count:
+            with self.lock:
+                if fresh:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return entry[0] if fresh else None
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _evict_locked(self, now):
+        for key in [key for key, entry in self.entries.items() if entry[1] <= now]:
+            del self.entries[key]
+        for key in [key for key, lock in self.key_locks.items() if key not in self.entries and not lock.locked()]:
+            del self.key_locks[key]
+
+    def _load(self, key):
+        try:
+            with get_db() as conn:
+                row = conn.execute(
+                    "SELECT access_token, expires_at FROM oauth_tokens WHERE cache_key = ?",
+                    (key,),
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        return row["access_token"], int(row["expires_at"])
+
+    def _save(self, key, access_token, expires_at):
+        try:
+            with get_db() as conn:
+                conn.execute(
+                    """
+                    INSERT INTO oauth_tokens (cache_key, access_token, expires_at, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(cache_key) DO UPDATE SET
+                        access_token = excluded.access_token,
+                        expires_at = excluded.expires_at,
+                        updated_at = excluded.updated_at
+                    """,
+                    (key, access_token, expires_at, int(time.time())),
+                )
+        except sqlite3.Error:
+            pass
+
+
+TOKEN_CACHE = TokenCache(TOKEN_CACHE_PERSIST)
+
+
+def token_cache_key(client_id, refresh_token):
+    raw = f"{client_id}\x00{refresh_token}".encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def get_access_token(client_id, refresh_token):
+    return TOKEN_CACHE.get(client_id, refresh_token)
 
 
 def generate_auth_string(email_name, access_token):
@@ -1030,27 +1565,207 @@ def parse_date(value):
 
 
 def connect_mailbox(mailbox):
-    mail = imaplib.IMAP4_SSL(IMAP_HOST)
+    mail = imaplib.IMAP4_SSL(IMAP_HOST, timeout=IMAP_TIMEOUT)
     if mailbox["refresh_token"]:
         if mailbox["client_id"]:
             access_token = get_access_token(mailbox["client_id"], mailbox["refresh_token"])
+            try:
+                mail.authenticate("XOAUTH2", lambda _: generate_auth_string(mailbox["address"], access_token))
+            except imaplib.IMAP4.error:
+                access_token = TOKEN_CACHE.get(mailbox["client_id"], mailbox["refresh_token"], force=True)
+                mail.authenticate("XOAUTH2", lambda _: generate_auth_string(mailbox["address"], access_token))
         else:
             access_token = mailbox["refresh_token"]
-        mail.authenticate("XOAUTH2", lambda _: generate_auth_string(mailbox["address"], access_token))
+            mail.authenticate("XOAUTH2", lambda _: generate_auth_string(mailbox["address"], access_token))
     elif mailbox["password"]:
         mail.login(mailbox["address"], mailbox["password"])
     else:
         raise MailError("No authentication data configured.")
+    try:
+        status, data = mail.capability()
+    except imaplib.IMAP4.error:
+        status, data = "NO", []
+    if status == "OK" and data and data[-1]:
+        mail.capabilities = tuple(data[-1].decode("ascii", errors="ignore").upper().split())
     return mail
 
 
-def extract_message(raw_email):
-    email_message = email.message_from_bytes(raw_email)
-    subject = decode_header_value(email_message.get("Subject"))
-    mail_from = decode_header_value(email_message.get("From"))
-    mail_to = decode_header_value(email_message.get("To"))
+class ImapPool:
+    def __init__(self, max_size, idle_timeout):
+        self.max_size = max(1, max_size)
+        self.idle_timeout = idle_timeout
+        self.cond = threading.Condition()
+        self.idle = {}
+        self.open_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.closed = 0
+
+    def acquire(self, mailbox):
+        address = mailbox["address"]
+        deadline = time.time() + IMAP_POOL_WAIT
+        while True:
+            candidate = None
+            stale = []
+            with self.cond:
+                stale.extend(self._expire_locked())
+                entries = self.idle.get(address)
+                if entries:
+                    candidate, _ = entries.pop()
+                    if not entries:
+                        del self.idle[address]
+                else:
+                    if self.open_count - len(stale) >= self.max_size:
+                        oldest = self._pop_oldest_locked()
+                        if oldest is not None:
+                            stale.append(oldest)
+                    if self.open_count < self.max_size + len(stale):
+                        self.open_count += 1
+                        candidate = False
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise MailError("IMAP connection pool exhausted.")
+                        self.cond.wait(remaining)
+                        continue
+            for mail in stale:
+                self._close(mail)
+            if candidate is False:
+                break
+            if self._is_alive(candidate):
+                with self.cond:
+                    self.hits += 1
+                return candidate
+            self._close(candidate)
+        try:
+            mail = connect_mailbox(mailbox)
+        except BaseException:
+            with self.cond:
+                self.open_count -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.misses += 1
+        return mail
+
+    def release(self, mailbox, mail, discard=False):
+        if discard:
+            self._close(mail)
+            return
+        with self.cond:
+            self.idle.setdefault(mailbox["address"], []).append((mail, time.time()))
+            self.cond.notify()
+
+    def drop(self, address):
+        with self.cond:
+            entries = self.idle.pop(address, [])
+        for mail, _ in entries:
+            self._close(mail)
+
+    def stats(self):
+        with self.cond:
+            stale = self._expire_locked()
+        for mail in stale:
+            self._close(mail)
+        with self.cond:
+            idle_count = sum(len(entries) for entries in self.idle.values())
+            total = self.hits + self.misses
+            return {
+                "open": self.open_count,
+                "idle": idle_count,
+                "in_use": self.open_count - idle_count,
+                "max_size": self.max_size,
+                "idle_timeout": self.idle_timeout,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "closed": self.closed,
+            }
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.idle_timeout
+        stale = []
+        for address in list(self.idle):
+            entries = self.idle[address]
+            keep = [entry for entry in entries if entry[1] >= cutoff]
+            stale.extend(mail for mail, last_used in entries if last_used < cutoff)
+            if keep:
+                self.idle[address] = keep
+            else:
+                del self.idle[address]
+        return stale
+
+    def _pop_oldest_locked(self):
+        oldest_address = None
+        oldest_index = None
+        oldest_ts = None
+        for address, entries in self.idle.items():
+            for idx, (_, last_used) in enumerate(entries):
+                if oldest_ts is None or last_used < oldest_ts:
+                    oldest_address, oldest_index, oldest_ts = address, idx, last_used
+        if oldest_address is None:
+            return None
+        entries = self.idle[oldest_address]
+        mail, _ = entries.pop(oldest_index)
+        if not entries:
+            del self.idle[oldest_address]
+        return mail
+
+    def _is_alive(self, mail):
+        try:
+            status, _ = mail.noop()
+        except (imaplib.IMAP4.error, OSError):
+            try:
+                mail.shutdown()
+            except OSError:
+                pass
+            return False
+        return status == "OK"
+
+    def _close(self, mail):
+        try:
+            mail.logout()
+        except Exception:
+            pass
+        with self.cond:
+            self.open_count -= 1
+            self.closed += 1
+            self.cond.notify()
+
+
+IMAP_POOL = ImapPool(IMAP_POOL_SIZE, IMAP_POOL_IDLE)
+
+
+@contextmanager
+def imap_session(mailbox):
+    mail = IMAP_POOL.acquire(mailbox)
+    reusable = False
+    try:
+        yield mail
+        reusable = True
+    except MailError:
+        reusable = True
+        raise
+    finally:
+        IMAP_POOL.release(mailbox, mail, discard=not reusable)
+
+
+def summarize_headers(email_message):
     mail_dt, mail_ts = parse_date(email_message.get("Date"))
+    return {
+        "subject": decode_header_value(email_message.get("Subject")),
+        "mail_from": decode_header_value(email_message.get("From")),
+        "mail_to": decode_header_value(email_message.get("To")),
+        "mail_dt": mail_dt,
+        "mail_ts": mail_ts,
+    }
+
 
+def extract_headers(raw_headers):
+    return summarize_headers(BytesHeaderParser().parsebytes(raw_headers))
+
+
+def extract_bodies(email_message):
     html_parts = []
     text_parts = []
     if email_message.is_multipart():
@@ -1067,128 +1782,2256 @@ def extract_message(raw_email):
         payload = email_message.get_payload(decode=True)
         html_parts.append(_decode_payload(payload, email_message.get_content_charset()))
 
-    body_html = "".join(html_parts).strip()
-    body_text = "\n".join(text_parts).strip()
-    return {
-        "subject": subject,
-        "mail_from": mail_from,
-        "mail_to": mail_to,
-        "mail_dt": mail_dt,
-        "mail_ts": mail_ts,
-        "body_html": body_html,
-        "body_text": body_text,
+    return "".join(html_parts).strip(), "\n".join(text_parts).strip()
+
+
+def extract_message(raw_email):
+    email_message = email.message_from_bytes(raw_email)
+    body_html, body_text = extract_bodies(email_message)
+    return {**summarize_headers(email_message), "body_html": body_html, "body_text": body_text}
+
+
+class HtmlSanitizer(HTMLParser):
+    dropped_tags = {"script", "base"}
+    dropped_attrs = {"srcdoc"}
+    url_attrs = {
+        "href",
+        "src",
+        "action",
+        "formaction",
+        "background",
+        "lowsrc",
+        "dynsrc",
+        "poster",
+        "data",
+        "codebase",
+        "cite",
+        "xlink:href",
     }
+    animation_attrs = {"values", "from", "to", "by"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.skip_depth = 0
+        self.raw_text = False
+
+    def emit_tag(self, tag, attrs, closing):
+        if tag in self.dropped_tags:
+            if tag == "script" and not closing:
+                self.skip_depth += 1
+            return
+        if tag == "meta" and any(
+            name == "http-equiv" and (value or "").strip().lower() == "refresh" for name, value in attrs
+        ):
+            return
+        parts = ["<", tag]
+        for name, value in attrs:
+            if name.startswith("on") or name in self.dropped_attrs or not SAFE_ATTR_RE.match(name):
+                continue
+            if value is None:
+                parts.append(f" {name}")
+                continue
+            if name in self.url_attrs and is_script_url(value):
+                continue
+            if name in self.animation_attrs and any(is_script_url(item) for item in value.split(";")):
+                continue
+            if name == "style":
+                value = SCRIPT_URL_RE.sub("", value)
+            parts.append(f' {name}="{html.escape(value, quote=True)}"')
+        parts.append(" />" if closing else ">")
+        self.out.append("".join(parts))
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_depth:
+            return
+        self.raw_text = tag == "style"
+        self.emit_tag(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        if not self.skip_depth:
+            self.emit_tag(tag, attrs, True)
+
+    def handle_endtag(self, tag):
+        if tag == "script":
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth or tag == "base":
+            return
+        self.raw_text = False
+        self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.raw_text:
+            self.out.append(SCRIPT_URL_RE.sub("", data).replace("<", "&lt;"))
+        else:
+            self.out.append(html.escape(data, quote=False))
+
+    def handle_decl(self, decl):
+        if decl.lower().startswith("doctype"):
+            self.out.append(f"<!{decl}>")
+
+
+def is_script_url(value):
+    return SCRIPT_URL_RE.match(re.sub(r"[\x00-\x20\x7f]", "", value)) is not None
+
+
+def escape_unclosed_markup(value):
+    last_close = value.rfind(">") + 1
+    head, tail = value[:last_close], value[last_close:]
+    comment_end = head.rfind("-->")
+    keep = max(0, comment_end - 3)
+    head = head[:keep] + head[keep:].replace("<!--", "&lt;!--")
+    return head + tail.replace("<", "&lt;")
 
 
 def sanitize_html(value):
     if not value:
         return ""
-    cleaned = re.sub(r"(?is)<script[^>]*>.*?</script>", "", value)
-    cleaned = re.sub(r"(?is)<base[^>]*>", "", cleaned)
-    cleaned = re.sub(r"(?is)on\w+\s*=\s*(['\"]).*?\1", "", cleaned)
-    cleaned = re.sub(r"(?is)javascript:", "", cleaned)
-    return cleaned
+    sanitizer = HtmlSanitizer()
+    sanitizer.feed(escape_unclosed_markup(value))
+    sanitizer.close()
+    return "".join(sanitizer.out)
+
+
+class SanitizeCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, max_bytes)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, value):
+        if not value or not self.max_bytes:
+            return sanitize_html(value)
+        key = hashlib.sha256(value.encode("utf-8", errors="surrogatepass")).hexdigest()
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        cleaned = sanitize_html(value)
+        cost = len(cleaned.encode("utf-8", errors="surrogatepass"))
+        if cost > self.max_bytes:
+            return cleaned
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (cleaned, cost)
+                self.size += cost
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted
+                    self.evictions += 1
+        return cleaned
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
 
 
-def list_messages(mailbox, limit):
-    mail = None
-    try:
-        mail = connect_mailbox(mailbox)
-        messages = []
-        folders = ["INBOX"] + JUNK_FOLDERS
-        for folder in folders:
-            try:
-                status, _ = mail.select(folder, readonly=True)
-            except imaplib.IMAP4.error:
-                continue
-            if status != "OK":
-                continue
+SANITIZE_CACHE = SanitizeCache(SANITIZE_CACHE_BYTES)
 
-            status, data = mail.uid("search", None, "ALL")
-            if status != "OK":
-                continue
 
-            uids = data[0].split()
-            if not uids:
-                continue
-            uids = uids[-limit:]
-            uids.reverse()
+def format_uid_set(uids):
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(
+        str(start) if start == end else f"{start}:{end}" for start, end in ranges
+    )
 
-            for uid in uids:
-                uid_str = uid.decode() if isinstance(uid, bytes) else str(uid)
-                status, msg_data = mail.uid("fetch", uid_str, "(RFC822)")
-                if status != "OK" or not msg_data:
-                    continue
-                raw_email = None
-                for part in msg_data:
-                    if isinstance(part, tuple) and len(part) > 1:
-                        raw_email = part[1]
-                        break
-                if not raw_email:
-                    continue
-                parsed = extract_message(raw_email)
-                parsed["uid"] = uid_str
-                parsed["folder"] = folder
-                parsed["folder_label"] = folder_label(folder)
-                messages.append(parsed)
 
-        messages.sort(key=lambda item: item.get("mail_ts", 0), reverse=True)
-        return messages[:limit]
-    finally:
-        if mail is not None:
-            try:
-                mail.logout()
-            except Exception:
-                pass
+def parse_fetch_response(msg_data):
+    records = []
+    current = None
+    for part in msg_data or []:
+        if isinstance(part, tuple):
+            head, literal = part[0], part[1]
+        else:
+            head, literal = part, None
+        if not isinstance(head, bytes):
+            continue
+        match = FETCH_START_RE.match(head)
+        if match or current is None:
+            current = {
+                "seq": int(match.group(1)) if match else 0,
+                "uid": "",
+                "text": b"",
+                "literals": {},
+            }
+            records.append(current)
+        current["text"] += head
+        if literal is not None:
+            name = FETCH_LITERAL_RE.search(head)
+            key = name.group(1).decode("ascii").upper() if name else ""
+            current["literals"][key] = literal
+    for record in records:
+        match = FETCH_UID_RE.search(record["text"])
+        if match:
+            record["uid"] = match.group(1).decode("ascii")
+    return records
+
+
+def fetch_uids(mail, uids, items):
+    if not uids:
+        return {}
+    status, msg_data = mail.uid("fetch", format_uid_set(uids), items)
+    if status != "OK" or not msg_data:
+        return {}
+    wanted = set(uids)
+    results = {}
+    for record in parse_fetch_response(msg_data):
+        if record["uid"] in wanted:
+            results[record["uid"]] = record
+    return results
+
+
+def summarize_fetch_record(record):
+    raw_headers = None
+    for key, literal in record["literals"].items():
+        if key.startswith("BODY[HEADER"):
+            raw_headers = literal
+            break
+    if raw_headers is None:
+        return None
+    parsed = extract_headers(raw_headers)
+    if not parsed["mail_ts"]:
+        internal = imaplib.Internaldate2tuple(record["text"])
+        if internal:
+            parsed["mail_dt"] = time.strftime("%Y-%m-%d %H:%M:%S", internal)
+            parsed["mail_ts"] = int(time.mktime(internal))
+    size = FETCH_SIZE_RE.search(record["text"])
+    parsed["size"] = int(size.group(1)) if size else 0
+    return parsed
+
+
+def parse_exists(data):
+    try:
+        return int(data[0])
+    except (IndexError, TypeError, ValueError):
+        return None
 
 
-def fetch_message(mailbox, uid, folder=None):
-    mail = None
+def quote_folder(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def select_folder(mail, folder):
     try:
-        mail = connect_mailbox(mailbox)
-        folder_name = normalize_folder(folder)
-        try:
-            status, _ = mail.select(folder_name, readonly=True)
-        except imaplib.IMAP4.error as exc:
-            raise MailError(f"Mailbox select failed: {exc}") from exc
-        if status != "OK":
-            raise MailError("Mailbox select failed.")
-        status, msg_data = mail.uid("fetch", uid, "(RFC822)")
-        if status != "OK" or not msg_data:
-            raise MailError("Message fetch failed.")
-        raw_email = None
-        for part in msg_data:
-            if isinstance(part, tuple) and len(part) > 1:
-                raw_email = part[1]
-                break
-        if not raw_email:
-            raise MailError("Message empty.")
-        parsed = extract_message(raw_email)
-        parsed["uid"] = uid
-        parsed["folder"] = folder_name
-        parsed["folder_label"] = folder_label(folder_name)
-        return parsed
-    finally:
-        if mail is not None:
-            try:
-                mail.logout()
-            except Exception:
-                pass
+        status, data = mail.select(quote_folder(folder), readonly=True)
+    except imaplib.IMAP4.error:
+        return None
+    if status != "OK":
+        return None
+    count = parse_exists(data)
+    return 0 if count is None else count
 
 
-def build_share_body(message):
-    if message["body_html"]:
-        return sanitize_html(message["body_html"])
-    if message["body_text"]:
-        return "<pre>" + html.escape(message["body_text"]) + "</pre>"
-    return "<p>(empty)</p>"
+def supports_condstore(mail):
+    return "CONDSTORE" in getattr(mail, "capabilities", ())
 
 
-def generate_share_code(conn):
-    alphabet = string.ascii_letters + string.digits
-    for _ in range(20):
-        code = "".join(secrets.choice(alphabet) for _ in range(SHARE_CODE_LEN))
-        if not (any(c.isalpha() for c in code) and any(c.isdigit() for c in code)):
+def folder_status(mail, folder):
+    items = "(MESSAGES UIDNEXT UIDVALIDITY"
+    if supports_condstore(mail):
+        items += " HIGHESTMODSEQ"
+    items += ")"
+    try:
+        status, data = mail.status(quote_folder(folder), items)
+    except imaplib.IMAP4.error:
+        return None
+    if status != "OK" or not data or not isinstance(data[0], bytes):
+        return None
+    text = data[0][data[0].rfind(b"("):]
+    values = {key.decode("ascii"): int(value) for key, value in STATUS_ITEM_RE.findall(text)}
+    if "UIDNEXT" not in values or "UIDVALIDITY" not in values:
+        return None
+    values.setdefault("MESSAGES", 0)
+    values.setdefault("HIGHESTMODSEQ", 0)
+    return values
+
+
+def tail_uids(mail, count, limit):
+    start = max(1, count - limit + 1)
+    try:
+        status, msg_data = mail.fetch(f"{start}:{count}", "(UID)")
+    except imaplib.IMAP4.error:
+        return None
+    if status != "OK":
+        return None
+    records = [
+        record
+        for record in parse_fetch_response(msg_data)
+        if record["uid"] and start <= record["seq"] <= count
+    ]
+    records.sort(key=lambda record: record["seq"], reverse=True)
+    return [record["uid"] for record in records]
+
+
+def search_uids(mail, limit, criteria="ALL"):
+    status, data = mail.uid("search", None, criteria)
+    if status != "OK" or not data or not data[0]:
+        return []
+    uids = data[0].split()
+    uids = [uid.decode() if isinstance(uid, bytes) else str(uid) for uid in uids]
+    if limit is not None:
+        uids = uids[-limit:]
+    uids.reverse()
+    return uids
+
+
+def summary_items(engine):
+    if engine == "full":
+        return "(UID FLAGS RFC822)"
+    return f"(UID FLAGS INTERNALDATE RFC822.SIZE {LIST_HEADER_FIELDS})"
+
+
+def summarize_records(records, folder, engine):
+    summaries = {}
+    for uid, record in records.items():
+        if engine == "full":
+            raw_email = record["literals"].get("RFC822")
+            if not raw_email:
+                parsed = None
+            elif STORE_BODIES:
+                parsed = extract_message(raw_email)
+            else:
+                parsed = extract_headers(raw_email)
+            if parsed is not None:
+                parsed["size"] = len(raw_email)
+        else:
+            parsed = summarize_fetch_record(record)
+        if parsed is None:
+            continue
+        flags = FETCH_FLAGS_RE.search(record["text"])
+        parsed["flags"] = flags.group(1).decode("ascii", errors="ignore") if flags else ""
+        parsed["uid"] = uid
+        parsed["folder"] = folder
+        parsed["folder_label"] = folder_label(folder)
+        summaries[uid] = parsed
+    return summaries
+
+
+def fetch_flag_changes(mail, low_uid, modseq):
+    try:
+        status, msg_data = mail.uid(
+            "fetch", f"{low_uid}:*", "(UID FLAGS)", f"(CHANGEDSINCE {modseq})"
+        )
+    except imaplib.IMAP4.error:
+        return {}
+    if status != "OK":
+        return {}
+    changes = {}
+    for record in parse_fetch_response(msg_data):
+        flags = FETCH_FLAGS_RE.search(record["text"])
+        if record["uid"] and flags:
+            changes[record["uid"]] = flags.group(1).decode("ascii", errors="ignore")
+    return changes
+
+
+def sync_folder(mail, mailbox, folder, engine=None):
+    engine = engine or LIST_ENGINE
+    mailbox_id = mailbox["id"]
+    status = folder_status(mail, folder)
+    if status is None:
+        return None
+    state = load_folder_state(mailbox_id, folder)
+    result = {"folder": folder, "changed": False, "new": 0, "flags": 0, "expunged": 0}
+    if (
+        state is not None
+        and state["low_uid"]
+        and state["uidvalidity"] == status["UIDVALIDITY"]
+        and state["uidnext"] == status["UIDNEXT"]
+        and state["message_count"] == status["MESSAGES"]
+        and state["highestmodseq"] == status["HIGHESTMODSEQ"]
+    ):
+        update_folder_state(mailbox_id, folder, synced_at=int(time.time()))
+        return result
+
+    count = select_folder(mail, folder)
+    if count is None:
+        return None
+    uidvalidity = status["UIDVALIDITY"]
+    record_folder_state(mailbox_id, folder, uidvalidity)
+    state = load_folder_state(mailbox_id, folder)
+    result["changed"] = True
+
+    incremental = bool(state["low_uid"])
+    if not incremental:
+        new_uids = tail_uids(mail, count, SYNC_DEPTH) if count else []
+        if new_uids is None:
+            new_uids = search_uids(mail, SYNC_DEPTH)
+        low_uid = min((int(uid) for uid in new_uids), default=status["UIDNEXT"])
+    else:
+        low_uid = state["low_uid"]
+        server_uids = [
+            uid for uid in search_uids(mail, None, f"UID {low_uid}:*") if int(uid) >= low_uid
+        ]
+        stored = stored_uids(mailbox_id, folder, uidvalidity, low_uid)
+        expunged = stored - set(server_uids)
+        if expunged:
+            delete_stored_uids(mailbox_id, folder, uidvalidity, expunged)
+        result["expunged"] = len(expunged)
+        if len(server_uids) > SYNC_WINDOW:
+            low_uid = int(server_uids[SYNC_WINDOW - 1])
+        new_uids = [uid for uid in server_uids if uid not in stored and int(uid) >= low_uid]
+        if supports_condstore(mail) and state["highestmodseq"]:
+            changes = fetch_flag_changes(mail, low_uid, state["highestmodseq"])
+            changes = {uid: flags for uid, flags in changes.items() if uid in stored}
+            update_stored_flags(mailbox_id, folder, uidvalidity, changes)
+            result["flags"] = len(changes)
+
+    summaries = summarize_records(fetch_uids(mail, new_uids, summary_items(engine)), folder, engine)
+    if summaries:
+        store_messages(mailbox_id, folder, uidvalidity, summaries.values())
+        if incremental:
+            for summary in sorted(summaries.values(), key=lambda item: int(item["uid"])):
+                EVENTS.publish("message", mailbox_id, message=message_summary(summary))
+    result["new"] = len(summaries)
+    update_folder_state(
+        mailbox_id,
+        folder,
+        uidnext=status["UIDNEXT"],
+        message_count=status["MESSAGES"],
+        highestmodseq=status["HIGHESTMODSEQ"],
+        low_uid=low_uid,
+        synced_at=int(time.time()),
+        prune_below=low_uid if incremental and low_uid > state["low_uid"] else None,
+    )
+    return result
+
+
+def extend_folder(mail, mailbox, folder, needed, engine=None):
+    engine = engine or LIST_ENGINE
+    mailbox_id = mailbox["id"]
+    state = load_folder_state(mailbox_id, folder)
+    if state is None or state["low_uid"] <= 1:
+        return 0
+    count = select_folder(mail, folder)
+    if count is None:
+        return 0
+    above = len(stored_uids(mailbox_id, folder, state["uidvalidity"], state["low_uid"]))
+    older = count - above
+    if older <= 0:
+        return 0
+    start = max(1, older - needed + 1)
+    try:
+        status, msg_data = mail.fetch(f"{start}:{older}", summary_items(engine))
+    except imaplib.IMAP4.error:
+        return 0
+    if status != "OK":
+        return 0
+    records = {
+        record["uid"]: record
+        for record in parse_fetch_response(msg_data)
+        if record["uid"] and int(record["uid"]) < state["low_uid"]
+    }
+    summaries = summarize_records(records, folder, engine)
+    if not summaries:
+        return 0
+    store_messages(mailbox_id, folder, state["uidvalidity"], summaries.values())
+    low_uid = min(int(uid) for uid in summaries)
+    if start == 1:
+        low_uid = 1
+    update_folder_state(mailbox_id, folder, low_uid=low_uid)
+    return len(summaries)
+
+
+def list_folder(mail, mailbox, folder, limit, engine):
+    if sync_folder(mail, mailbox, folder, engine) is None:
+        return []
+    state = load_folder_state(mailbox["id"], folder)
+    messages = read_folder(mailbox["id"], folder, state, limit)
+    if len(messages) < limit and state["low_uid"] > 1:
+        if extend_folder(mail, mailbox, folder, limit - len(messages), engine):
+            state = load_folder_state(mailbox["id"], folder)
+            messages = read_folder(mailbox["id"], folder, state, limit)
+    return messages
+
+
+def unquote_imap_string(value):
+    if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    return value
+
+
+def parse_folder_list(data):
+    folders = []
+    for item in data or []:
+        if isinstance(item, tuple):
+            head, literal = item[0], item[1]
+            match = FOLDER_LIST_RE.match(head.rstrip() + b" x")
+            name = literal.decode("utf-8", errors="ignore") if literal else ""
+        elif isinstance(item, bytes):
+            match = FOLDER_LIST_RE.match(item)
+            name = unquote_imap_string(match.group("name").decode("utf-8", errors="ignore")) if match else ""
+        else:
+            continue
+        if not match or not name:
+            continue
+        flags = match.group("flags").decode("ascii", errors="ignore").split()
+        folders.append((name, [flag.lower() for flag in flags]))
+    return folders
+
+
+def pick_scan_folders(folders):
+    junk_names = {name.lower() for name in JUNK_FOLDERS}
+    scan = ["INBOX"]
+    seen = {"inbox"}
+    for name, flags in folders:
+        if "\\noselect" in flags or "\\nonexistent" in flags:
+            continue
+        if "\\junk" in flags or name.lower() in junk_names:
+            if name.lower() not in seen:
+                seen.add(name.lower())
+                scan.append(name)
+    return scan
+
+
+def load_folder_cache(mailbox_id):
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT folders, checked_at FROM mailbox_folders WHERE mailbox_id = ?",
+            (mailbox_id,),
+        ).fetchone()
+    if row is None or int(row["checked_at"]) < time.time() - FOLDER_CACHE_TTL:
+        return None
+    try:
+        return json.loads(row["folders"])
+    except ValueError:
+        return None
+
+
+def discover_folders(mailbox, mail):
+    try:
+        status, data = mail.list()
+    except imaplib.IMAP4.error:
+        return None
+    if status != "OK":
+        return None
+    folders = parse_folder_list(data)
+    resolved = {
+        "names": ["INBOX"] + [name for name, _ in folders if name.upper() != "INBOX"],
+        "scan": pick_scan_folders(folders),
+    }
+    with get_db() as conn:
+        conn.execute(
+            """
+            INSERT INTO mailbox_folders (mailbox_id, folders, checked_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(mailbox_id) DO UPDATE SET
+                folders = excluded.folders,
+                checked_at = excluded.checked_at
+            """,
+            (mailbox["id"], json.dumps(resolved), int(time.time())),
+        )
+    return resolved
+
+
+def resolve_folders(mailbox, mail=None, refresh=False):
+    resolved = None if refresh else load_folder_cache(mailbox["id"])
+    if resolved is None:
+        if mail is None:
+            with imap_session(mailbox) as session:
+                resolved = discover_folders(mailbox, session)
+        else:
+            resolved = discover_folders(mailbox, mail)
+    if resolved is None:
+        return {"names": ["INBOX"] + JUNK_FOLDERS, "scan": ["INBOX"] + JUNK_FOLDERS}
+    return resolved
+
+
+def match_folder(names, folder):
+    for name in names:
+        if name.lower() == folder.lower():
+            return name
+    return None
+
+
+def folder_uidvalidity(mail):
+    _, data = mail.response("UIDVALIDITY")
+    try:
+        return int(data[0])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def load_folder_state(mailbox_id, folder):
+    with get_db() as conn:
+        return conn.execute(
+            "SELECT * FROM folder_state WHERE mailbox_id = ? AND folder = ?",
+            (mailbox_id, folder),
+        ).fetchone()
+
+
+def record_folder_state(mailbox_id, folder, uidvalidity):
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT uidvalidity FROM folder_state WHERE mailbox_id = ? AND folder = ?",
+            (mailbox_id, folder),
+        ).fetchone()
+        if row is not None and int(row["uidvalidity"]) != uidvalidity:
+            conn.execute(
+                "DELETE FROM messages WHERE mailbox_id = ? AND folder = ? AND uidvalidity != ?",
+                (mailbox_id, folder, uidvalidity),
+            )
+            conn.execute(
+                """
+                UPDATE folder_state
+                SET uidnext = 0, highestmodseq = 0, message_count = 0, low_uid = 0
+                WHERE mailbox_id = ? AND folder = ?
+                """,
+                (mailbox_id, folder),
+            )
+        conn.execute(
+            """
+            INSERT INTO folder_state (mailbox_id, folder, uidvalidity, checked_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(mailbox_id, folder) DO UPDATE SET
+                uidvalidity = excluded.uidvalidity,
+                checked_at = excluded.checked_at
+            """,
+            (mailbox_id, folder, uidvalidity, int(time.time())),
+        )
+
+
+def update_folder_state(mailbox_id, folder, prune_below=None, **fields):
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with get_db() as conn:
+        if prune_below is not None:
+            conn.execute(
+                "DELETE FROM messages WHERE mailbox_id = ? AND folder = ? AND uid < ?",
+                (mailbox_id, folder, prune_below),
+            )
+        conn.execute(
+            f"UPDATE folder_state SET {assignments} WHERE mailbox_id = ? AND folder = ?",
+            (*fields.values(), mailbox_id, folder),
+        )
+
+
+def stored_uids(mailbox_id, folder, uidvalidity, low_uid):
+    with get_db() as conn:
+        rows = conn.execute(
+            """
+            SELECT uid FROM messages
+            WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid >= ?
+            """,
+            (mailbox_id, folder, uidvalidity, low_uid),
+        ).fetchall()
+    return {str(row["uid"]) for row in rows}
+
+
+def delete_stored_uids(mailbox_id, folder, uidvalidity, uids):
+    with get_db() as conn:
+        conn.executemany(
+            "DELETE FROM messages WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            [(mailbox_id, folder, uidvalidity, int(uid)) for uid in uids],
+        )
+
+
+def update_stored_flags(mailbox_id, folder, uidvalidity, changes):
+    if not changes:
+        return
+    with get_db() as conn:
+        conn.executemany(
+            "UPDATE messages SET flags = ? WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            [
+                (flags, mailbox_id, folder, uidvalidity, int(uid))
+                for uid, flags in changes.items()
+            ],
+        )
+
+
+def read_folder(mailbox_id, folder, state, limit, before_uid=None):
+    if before_uid is None:
+        before_uid = 2**32
+    with get_db() as conn:
+        rows = conn.execute(
+            """
+            SELECT * FROM messages
+            WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid >= ? AND uid < ?
+            ORDER BY uid DESC
+            LIMIT ?
+            """,
+            (mailbox_id, folder, state["uidvalidity"], state["low_uid"], before_uid, limit),
+        ).fetchall()
+    return [stored_message(row) for row in rows]
+
+
+def stored_message(row, with_body=False):
+    message = {
+        "uid": str(row["uid"]),
+        "subject": row["subject"] or "",
+        "mail_from": row["mail_from"] or "",
+        "mail_to": row["mail_to"] or "",
+        "mail_dt": row["mail_dt"] or "",
+        "mail_ts": row["mail_ts"],
+        "size": row["size"],
+        "folder": row["folder"],
+        "folder_label": folder_label(row["folder"]),
+    }
+    if with_body:
+        message["body_html"] = row["body_html"] or ""
+        message["body_text"] = row["body_text"] or ""
+        message["parts"] = json.loads(row["parts"]) if row["parts"] is not None else None
+    return message
+
+
+def store_message_parts(mailbox_id, folder, uidvalidity, uid, parts):
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE messages SET parts = ? WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            (json.dumps(parts), mailbox_id, folder, uidvalidity, int(uid)),
+        )
+
+
+def find_stored_match(mailbox_id, since, sender="", subject_re=None):
+    with get_db() as conn:
+        rows = conn.execute(
+            """
+            SELECT m.* FROM messages m
+            JOIN folder_state f
+              ON f.mailbox_id = m.mailbox_id AND f.folder = m.folder AND f.uidvalidity = m.uidvalidity
+            WHERE m.mailbox_id = ? AND m.mail_ts >= ?
+            ORDER BY m.mail_ts DESC
+            LIMIT 500
+            """,
+            (mailbox_id, since),
+        ).fetchall()
+    sender = sender.lower()
+    for row in rows:
+        if sender and sender not in (row["mail_from"] or "").lower():
+            continue
+        if subject_re is not None and not subject_re.search(row["subject"] or ""):
+            continue
+        return stored_message(row)
+    return None
+
+
+def load_cached_body(mailbox_id, folder, uid):
+    with get_db() as conn:
+        row = conn.execute(
+            """
+            SELECT m.* FROM messages m
+            JOIN folder_state f
+              ON f.mailbox_id = m.mailbox_id AND f.folder = m.folder AND f.uidvalidity = m.uidvalidity
+            WHERE m.mailbox_id = ? AND lower(m.folder) = lower(?) AND m.uid = ? AND m.has_body = 1
+            """,
+            (mailbox_id, folder, int(uid)),
+        ).fetchone()
+    return stored_message(row, with_body=True) if row is not None else None
+
+
+def fts_enabled(conn):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    ).fetchone()
+    return row is not None
+
+
+def html_to_text(value):
+    if not value:
+        return ""
+    text = re.sub(r"(?is)<(script|style)[^>]*>.*?</\1>", " ", value)
+    text = re.sub(r"(?s)<[^>]+>", " ", text)
+    return re.sub(r"\s+", " ", html.unescape(text)).strip()
+
+
+def index_message(conn, mailbox_id, folder, uidvalidity, message):
+    row = conn.execute(
+        "SELECT id FROM messages WHERE mailbox_id = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+        (mailbox_id, folder, uidvalidity, int(message["uid"])),
+    ).fetchone()
+    if row is None:
+        return
+    if not STORE_BODIES:
+        body = ""
+    elif "body_html" in message:
+        body = message.get("body_text") or html_to_text(message.get("body_html"))
+    else:
+        existing = conn.execute(
+            "SELECT body FROM messages_fts WHERE rowid = ?", (row["id"],)
+        ).fetchone()
+        body = existing["body"] if existing else ""
+    conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (row["id"],))
+    conn.execute(
+        "INSERT INTO messages_fts (rowid, subject, mail_from, mail_to, body) VALUES (?, ?, ?, ?, ?)",
+        (
+            row["id"],
+            message.get("subject") or "",
+            message.get("mail_from") or "",
+            message.get("mail_to") or "",
+            body,
+        ),
+    )
+
+
+def fts_query(value):
+    terms = [term.replace('"', '""') for term in value.split()]
+    if not terms:
+        return ""
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_messages(query, user_key, address=None, limit=DEFAULT_LIMIT):
+    clauses = []
+    params = []
+    if MULTI_USER:
+        clauses.append("mailboxes.owner_key = ?")
+        params.append(user_key)
+    if address:
+        clauses.append("mailboxes.address = ?")
+        params.append(address)
+    with get_db() as conn:
+        if fts_enabled(conn):
+            match = fts_query(query)
+            if not match:
+                return []
+            where = " AND ".join(["messages_fts MATCH ?"] + clauses)
+            rows = conn.execute(
+                f"""
+                SELECT messages.*, mailboxes.address,
+                    snippet(messages_fts, -1, '', '', '...', 16) AS snippet
+                FROM messages_fts
+                JOIN messages ON messages.id = messages_fts.rowid
+                JOIN mailboxes ON mailboxes.id = messages.mailbox_id
+                WHERE {where}
+                ORDER BY bm25(messages_fts, 10.0, 4.0, 2.0, 1.0)
+                LIMIT ?
+                """,
+                [match] + params + [limit],
+            ).fetchall()
+        else:
+            like = "%" + re.sub(r"([\\%_])", r"\\\1", query.strip()) + "%"
+            where = " AND ".join(
+                [
+                    "(messages.subject LIKE ? ESCAPE '\\' OR messages.mail_from LIKE ? ESCAPE '\\' "
+                    "OR messages.mail_to LIKE ? ESCAPE '\\' OR messages.body_text LIKE ? ESCAPE '\\')"
+                ]
+                + clauses
+            )
+            rows = conn.execute(
+                f"""
+                SELECT messages.*, mailboxes.address, '' AS snippet
+                FROM messages
+                JOIN mailboxes ON mailboxes.id = messages.mailbox_id
+                WHERE {where}
+                ORDER BY messages.mail_ts DESC
+                LIMIT ?
+                """,
+                [like, like, like, like] + params + [limit],
+            ).fetchall()
+    results = []
+    for row in rows:
+        message = stored_message(row)
+        message["address"] = row["address"]
+        message["snippet"] = row["snippet"]
+        results.append(message)
+    return results
+
+
+def store_messages(mailbox_id, folder, uidvalidity, messages):
+    now = int(time.time())
+    with get_db() as conn:
+        fts = fts_enabled(conn)
+        for message in messages:
+            has_body = STORE_BODIES and "body_html" in message
+            conn.execute(
+                """
+                INSERT INTO messages (
+                    mailbox_id, folder, uidvalidity, uid, subject, mail_from, mail_to,
+                    mail_dt, mail_ts, size, flags, body_html, body_text, parts, has_body, fetched_at
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(mailbox_id, folder, uidvalidity, uid) DO UPDATE SET
+                    subject = excluded.subject,
+                    mail_from = excluded.mail_from,
+                    mail_to = excluded.mail_to,
+                    mail_dt = excluded.mail_dt,
+                    mail_ts = excluded.mail_ts,
+                    size = CASE WHEN excluded.size > 0 THEN excluded.size ELSE messages.size END,
+                    flags = CASE WHEN excluded.flags != '' THEN excluded.flags ELSE messages.flags END,
+                    body_html = CASE WHEN excluded.has_body THEN excluded.body_html ELSE messages.body_html END,
+                    body_text = CASE WHEN excluded.has_body THEN excluded.body_text ELSE messages.body_text END,
+                    parts = CASE
+                        WHEN excluded.has_body AND excluded.parts IS NOT NULL THEN excluded.parts
+                        ELSE messages.parts
+                    END,
+                    has_body = MAX(messages.has_body, excluded.has_body),
+                    fetched_at = excluded.fetched_at
+                """,
+                (
+                    mailbox_id,
+                    folder,
+                    uidvalidity,
+                    int(message["uid"]),
+                    message.get("subject"),
+                    message.get("mail_from"),
+                    message.get("mail_to"),
+                    message.get("mail_dt"),
+                    message.get("mail_ts") or 0,
+                    message.get("size") or 0,
+                    message.get("flags") or "",
+                    message.get("body_html") if has_body else None,
+                    message.get("body_text") if has_body else None,
+                    json.dumps(message["parts"]) if has_body and message.get("parts") is not None else None,
+                    1 if has_body else 0,
+                    now,
+                ),
+            )
+            if fts:
+                index_message(conn, mailbox_id, folder, uidvalidity, message)
+
+
+FOLDER_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, FOLDER_WORKERS), thread_name_prefix="folder")
+
+
+def timed_list_folder(mail, mailbox, folder, limit, engine):
+    started = time.perf_counter()
+    messages = list_folder(mail, mailbox, folder, limit, engine)
+    elapsed = round((time.perf_counter() - started) * 1000, 1)
+    return messages, {"folder": folder, "count": len(messages), "ms": elapsed}
+
+
+def scan_folder(mailbox, folder, limit, engine):
+    with imap_session(mailbox) as mail:
+        return timed_list_folder(mail, mailbox, folder, limit, engine)
+
+
+def merge_folder_messages(folder_lists, limit):
+    merged = heapq.merge(*folder_lists, key=lambda item: item.get("mail_ts", 0), reverse=True)
+    page = list(itertools.islice(merged, limit))
+    page.sort(key=lambda item: item.get("mail_ts", 0), reverse=True)
+    return page
+
+
+def list_stored_messages(mailbox, limit):
+    resolved = load_folder_cache(mailbox["id"])
+    if resolved is None:
+        return None
+    folder_lists = []
+    for folder in resolved["scan"]:
+        state = load_folder_state(mailbox["id"], folder)
+        if state is None or not state["low_uid"]:
+            return None
+        folder_messages = read_folder(mailbox["id"], folder, state, limit)
+        if len(folder_messages) < limit and state["low_uid"] > 1:
+            return None
+        folder_lists.append(folder_messages)
+    return merge_folder_messages(folder_lists, limit)
+
+
+def encode_cursor(bounds):
+    raw = json.dumps(bounds, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(value):
+    try:
+        bounds = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except ValueError:
+        raise MailError("Invalid cursor.")
+    if not isinstance(bounds, dict) or not bounds:
+        raise MailError("Invalid cursor.")
+    for folder, bound in bounds.items():
+        if (
+            not isinstance(bound, list)
+            or len(bound) != 2
+            or not all(isinstance(value, int) for value in bound)
+        ):
+            raise MailError("Invalid cursor.")
+    return bounds
+
+
+def build_cursor(mailbox_id, folders, messages, previous=None):
+    bounds = dict(previous or {})
+    for folder in folders:
+        state = load_folder_state(mailbox_id, folder)
+        if state is None:
+            continue
+        uids = [int(msg["uid"]) for msg in messages if msg.get("folder") == folder]
+        if uids:
+            bounds[folder] = [state["uidvalidity"], min(uids)]
+        elif folder not in bounds and state["uidnext"]:
+            bounds[folder] = [state["uidvalidity"], state["uidnext"]]
+    return encode_cursor(bounds) if bounds else None
+
+
+def page_messages(mailbox, bounds, limit, engine=None, meta=None):
+    engine = engine or LIST_ENGINE
+    started = time.perf_counter()
+    folder_lists = []
+    for folder, (uidvalidity, before_uid) in bounds.items():
+        state = load_folder_state(mailbox["id"], folder)
+        if state is None or state["uidvalidity"] != uidvalidity:
+            raise MailError("Cursor expired.")
+        folder_messages = read_folder(mailbox["id"], folder, state, limit, before_uid)
+        if len(folder_messages) < limit and state["low_uid"] > 1:
+            with imap_session(mailbox) as mail:
+                extended = extend_folder(mail, mailbox, folder, limit - len(folder_messages), engine)
+            if extended:
+                state = load_folder_state(mailbox["id"], folder)
+                folder_messages = read_folder(mailbox["id"], folder, state, limit, before_uid)
+        folder_lists.append(folder_messages)
+    messages = merge_folder_messages(folder_lists, limit)
+    if meta is not None:
+        meta["mode"] = "page"
+        meta["folders"] = []
+        meta["next_cursor"] = (
+            build_cursor(mailbox["id"], list(bounds), messages, bounds)
+            if len(messages) == limit
+            else None
+        )
+        meta["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return messages
+
+
+def parse_filter_time(value):
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+    except ValueError:
+        raise MailError("Invalid date, use a unix timestamp or YYYY-MM-DD.")
+
+
+def parse_message_filters(args):
+    filters = {}
+    for key in ("from", "subject"):
+        value = args.get(key, "").strip()
+        if value and not value.isprintable():
+            raise MailError(f"Invalid {key}, control characters are not allowed.")
+        if value:
+            filters[key] = value
+    for key in ("since", "before"):
+        value = args.get(key, "").strip()
+        if value:
+            filters[key] = parse_filter_time(value)
+    return filters
+
+
+def imap_date(ts):
+    parts = time.gmtime(ts)
+    return f"{parts.tm_mday}-{imaplib.Months[parts.tm_mon]}-{parts.tm_year}"
+
+
+def imap_search_string(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def build_search_criteria(filters):
+    criteria = []
+    for key, keyword in (("from", "FROM"), ("subject", "SUBJECT")):
+        value = filters.get(key)
+        if value and value.isascii() and value.isprintable():
+            criteria.append(f"{keyword} {imap_search_string(value)}")
+    if filters.get("since") is not None:
+        criteria.append(f"SINCE {imap_date(filters['since'] - 86400)}")
+    if filters.get("before") is not None:
+        criteria.append(f"BEFORE {imap_date(filters['before'] + 86400)}")
+    return " ".join(criteria) or "ALL"
+
+
+def message_matches(message, filters):
+    if "from" in filters and filters["from"].lower() not in (message.get("mail_from") or "").lower():
+        return False
+    if "subject" in filters and filters["subject"].lower() not in (message.get("subject") or "").lower():
+        return False
+    mail_ts = message.get("mail_ts") or 0
+    if "since" in filters and mail_ts < filters["since"]:
+        return False
+    if "before" in filters and mail_ts >= filters["before"]:
+        return False
+    return True
+
+
+def filter_folder(mailbox, folder, filters, limit, engine):
+    started = time.perf_counter()
+    matches = []
+    with imap_session(mailbox) as mail:
+        if select_folder(mail, folder) is not None:
+            uidvalidity = folder_uidvalidity(mail)
+            if uidvalidity is not None:
+                record_folder_state(mailbox["id"], folder, uidvalidity)
+            uids = search_uids(mail, SYNC_WINDOW, build_search_criteria(filters))
+            for offset in range(0, len(uids), limit):
+                batch = uids[offset : offset + limit]
+                summaries = summarize_records(
+                    fetch_uids(mail, batch, summary_items(engine)), folder, engine
+                )
+                if summaries and uidvalidity is not None:
+                    store_messages(mailbox["id"], folder, uidvalidity, summaries.values())
+                for uid in batch:
+                    if uid in summaries and message_matches(summaries[uid], filters):
+                        matches.append(summaries[uid])
+                if len(matches) >= limit:
+                    break
+    elapsed = round((time.perf_counter() - started) * 1000, 1)
+    return matches[:limit], {"folder": folder, "count": len(matches[:limit]), "ms": elapsed}
+
+
+def filter_messages(mailbox, filters, limit, engine=None, meta=None):
+    engine = engine or LIST_ENGINE
+    started = time.perf_counter()
+    folders = resolve_folders(mailbox)["scan"]
+    if LIST_PARALLEL and len(folders) > 1:
+        futures = [
+            FOLDER_EXECUTOR.submit(filter_folder, mailbox, folder, filters, limit, engine)
+            for folder in folders
+        ]
+        results = [future.result() for future in futures]
+    else:
+        results = [filter_folder(mailbox, folder, filters, limit, engine) for folder in folders]
+    messages = []
+    for folder_messages, _ in results:
+        messages.extend(folder_messages)
+    messages.sort(key=lambda item: item.get("mail_ts", 0), reverse=True)
+    if meta is not None:
+        meta["mode"] = "search"
+        meta["criteria"] = build_search_criteria(filters)
+        meta["folders"] = [timing for _, timing in results]
+        meta["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return messages[:limit]
+
+
+def list_messages(mailbox, limit, engine=None, meta=None, emit=None):
+    engine = engine or LIST_ENGINE
+    started = time.perf_counter()
+    SYNC_SCHEDULER.touch(mailbox["id"])
+    if SYNC_SCHEDULER.is_fresh(mailbox["id"]):
+        messages = list_stored_messages(mailbox, limit)
+        if messages is not None:
+            if emit is not None:
+                emit(messages)
+            if meta is not None:
+                meta["mode"] = "store"
+                meta["folders"] = []
+                meta["synced_at"] = SYNC_SCHEDULER.last_synced(mailbox["id"])
+                meta["next_cursor"] = (
+                    build_cursor(mailbox["id"], load_folder_cache(mailbox["id"])["scan"], messages)
+                    if len(messages) == limit
+                    else None
+                )
+                meta["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            return messages
+    folders = resolve_folders(mailbox)["scan"]
+    parallel = LIST_PARALLEL and len(folders) > 1
+    results = []
+    if parallel:
+        futures = [
+            FOLDER_EXECUTOR.submit(scan_folder, mailbox, folder, limit, engine)
+            for folder in folders
+        ]
+        if emit is not None:
+            for future in as_completed(futures):
+                emit(future.result()[0])
+        results = [future.result() for future in futures]
+    else:
+        with imap_session(mailbox) as mail:
+            for folder in folders:
+                results.append(timed_list_folder(mail, mailbox, folder, limit, engine))
+                if emit is not None:
+                    emit(results[-1][0])
+
+    messages = merge_folder_messages([folder_messages for folder_messages, _ in results], limit)
+    SYNC_SCHEDULER.mark_synced(mailbox, time.perf_counter() - started)
+    if meta is not None:
+        meta["mode"] = "parallel" if parallel else "serial"
+        meta["folders"] = [timing for _, timing in results]
+        meta["next_cursor"] = (
+            build_cursor(mailbox["id"], folders, messages) if len(messages) == limit else None
+        )
+        meta["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return messages
+
+
+def imap_tokens(msg_data):
+    tokens = []
+    for part in msg_data or []:
+        if isinstance(part, tuple):
+            head, literal = part[0], part[1]
+        else:
+            head, literal = part, None
+        if not isinstance(head, bytes):
+            continue
+        for match in IMAP_TOKEN_RE.finditer(head):
+            token = match.group(0)
+            if token.startswith(b"{"):
+                continue
+            if token.startswith(b'"'):
+                tokens.append(("string", re.sub(rb"\\(.)", rb"\1", token[1:-1])))
+            else:
+                tokens.append(token)
+        if literal is not None:
+            tokens.append(("string", literal))
+    return tokens
+
+
+def parse_imap_tree(tokens):
+    stack = [[]]
+    for token in tokens:
+        if token == b"(":
+            stack.append([])
+        elif token == b")":
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        elif isinstance(token, tuple):
+            stack[-1].append(token[1].decode("utf-8", errors="replace"))
+        elif token.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token.decode("ascii", errors="replace"))
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    return stack[0]
+
+
+def find_fetch_item(tree, name):
+    for node in tree:
+        if isinstance(node, list):
+            for index, item in enumerate(node[:-1]):
+                if isinstance(item, str) and item.upper() == name:
+                    return node[index + 1]
+    return None
+
+
+def structure_params(value):
+    params = {}
+    if isinstance(value, list):
+        for index in range(0, len(value) - 1, 2):
+            if isinstance(value[index], str):
+                params[value[index].lower()] = value[index + 1]
+    return params
+
+
+def structure_parts(structure, prefix=""):
+    if not isinstance(structure, list) or not structure:
+        return []
+    if isinstance(structure[0], list):
+        parts = []
+        for index, child in enumerate(structure, 1):
+            if not isinstance(child, list):
+                break
+            parts.extend(structure_parts(child, f"{prefix}{index}."))
+        return parts
+    if len(structure) < 7:
+        return []
+    maintype = (structure[0] or "").lower()
+    subtype = (structure[1] or "").lower()
+    nested = None
+    if maintype == "text":
+        extension = 8
+    elif maintype == "message" and subtype == "rfc822":
+        extension = 10
+        if len(structure) > 8 and isinstance(structure[8], list) and structure[8]:
+            nested = structure[8]
+    else:
+        extension = 7
+    disposition = structure[extension + 1] if len(structure) > extension + 1 else None
+    if not isinstance(disposition, list) or not disposition:
+        disposition = [None, None]
+    params = structure_params(structure[2])
+    filename = structure_params(disposition[1]).get("filename") or params.get("name") or ""
+    size = structure[6] if isinstance(structure[6], str) and structure[6].isdigit() else "0"
+    section = prefix.rstrip(".") or "1"
+    parts = [
+        {
+            "section": section,
+            "content_type": f"{maintype}/{subtype}",
+            "charset": params.get("charset"),
+            "encoding": (structure[5] or "7bit").lower(),
+            "size": int(size),
+            "filename": decode_header_value(filename) if filename else "",
+            "content_id": (structure[3] or "").strip().strip("<>"),
+            "disposition": (disposition[0] or "").lower(),
+        }
+    ]
+    if nested is not None:
+        parts.extend(structure_parts(nested, f"{section}." if isinstance(nested[0], list) else f"{section}.1."))
+    return parts
+
+
+def text_sections(parts):
+    return [
+        part
+        for part in parts
+        if part["content_type"] in ("text/html", "text/plain") and part["disposition"] != "attachment"
+    ]
+
+
+def attachment_parts(parts):
+    sections = text_sections(parts)
+    return [part for part in parts if part not in sections]
+
+
+def decode_transfer(payload, encoding):
+    if encoding == "base64":
+        try:
+            return base64.b64decode(payload)
+        except ValueError:
+            return b""
+    if encoding == "quoted-printable":
+        return quopri.decodestring(payload)
+    return payload
+
+
+def fetch_message_parts(mail, uid):
+    status, msg_data = mail.uid(
+        "fetch", uid, f"(UID RFC822.SIZE INTERNALDATE BODYSTRUCTURE {LIST_HEADER_FIELDS})"
+    )
+    if status != "OK" or not msg_data:
+        return None
+    records = [record for record in parse_fetch_response(msg_data) if record["uid"] == str(uid)]
+    if not records:
+        return None
+    parsed = summarize_fetch_record(records[0])
+    structure = find_fetch_item(parse_imap_tree(imap_tokens(msg_data)), "BODYSTRUCTURE")
+    if parsed is None or not isinstance(structure, list):
+        return None
+    multipart = isinstance(structure[0], list)
+    parts = structure_parts(structure)
+    sections = text_sections(parts)
+    bodies = {}
+    if sections:
+        items = " ".join(f"BODY.PEEK[{part['section']}]" for part in sections)
+        records = fetch_uids(mail, [str(uid)], f"(UID {items})")
+        if str(uid) not in records:
+            return None
+        bodies = records[str(uid)]["literals"]
+    html_parts = []
+    text_parts = []
+    for part in sections:
+        payload = decode_transfer(bodies.get(f"BODY[{part['section']}]", b""), part["encoding"])
+        value = _decode_payload(payload, part["charset"])
+        if part["content_type"] == "text/html" or not multipart:
+            html_parts.append(value)
+        else:
+            text_parts.append(value)
+    parsed["body_html"] = "".join(html_parts).strip()
+    parsed["body_text"] = "\n".join(text_parts).strip()
+    parsed["parts"] = attachment_parts(parts)
+    return parsed
+
+
+def fetch_structure(mail, uid):
+    status, msg_data = mail.uid("fetch", uid, "(UID BODYSTRUCTURE)")
+    if status != "OK" or not msg_data:
+        return None
+    structure = find_fetch_item(parse_imap_tree(imap_tokens(msg_data)), "BODYSTRUCTURE")
+    return structure if isinstance(structure, list) else None
+
+
+class TransferDecoder:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.carry = b""
+
+    def feed(self, data):
+        if self.encoding == "base64":
+            data = self.carry + re.sub(rb"[^A-Za-z0-9+/=]", b"", data)
+            usable = len(data) - len(data) % 4
+            self.carry = data[usable:]
+            return decode_transfer(data[:usable], "base64")
+        if self.encoding == "quoted-printable":
+            data = self.carry + data
+            cut = data.rfind(b"\n") + 1
+            self.carry = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return data
+
+    def flush(self):
+        data, self.carry = self.carry, b""
+        if not data:
+            return b""
+        return decode_transfer(data, self.encoding)
+
+
+def stream_part(mail, uid, part, chunk_size):
+    decoder = TransferDecoder(part["encoding"])
+    offset = 0
+    key = f"BODY[{part['section']}]"
+    while True:
+        records = fetch_uids(
+            mail, [str(uid)], f"(UID BODY.PEEK[{part['section']}]<{offset}.{chunk_size}>)"
+        )
+        record = records.get(str(uid))
+        if record is None:
+            raise MailError("Part fetch failed.")
+        chunk = b""
+        for name, literal in record["literals"].items():
+            if name.startswith(key):
+                chunk = literal
+                break
+        offset += len(chunk)
+        data = decoder.feed(chunk)
+        if data:
+            yield data
+        if len(chunk) < chunk_size:
+            break
+    data = decoder.flush()
+    if data:
+        yield data
+
+
+def open_message_folder(mail, mailbox, folder_name):
+    existing = match_folder(resolve_folders(mailbox, mail)["names"], folder_name)
+    if existing is None:
+        existing = match_folder(resolve_folders(mailbox, mail, refresh=True)["names"], folder_name)
+    if existing is None:
+        raise MailError("Folder not found.")
+    if select_folder(mail, existing) is None:
+        raise MailError("Mailbox select failed.")
+    return existing
+
+
+def find_message_part(mailbox, uid, section, folder=None):
+    if not str(uid).isdigit():
+        raise MailError("Invalid UID.")
+    if not SECTION_RE.match(section or ""):
+        raise MailError("Invalid section.")
+    with imap_session(mailbox) as mail:
+        folder_name = open_message_folder(mail, mailbox, normalize_folder(folder))
+        structure = fetch_structure(mail, uid)
+    if structure is None:
+        raise MailError("Message fetch failed.")
+    for part in structure_parts(structure):
+        if part["section"] == section:
+            return folder_name, part
+    raise MailError("Part not found.")
+
+
+def open_part_stream(mailbox, uid, folder_name, part):
+    with imap_session(mailbox) as mail:
+        if select_folder(mail, folder_name) is None:
+            raise MailError("Mailbox select failed.")
+        yield from stream_part(mail, uid, part, PART_CHUNK)
+
+
+def link_inline_images(value, address, message):
+    images = {
+        part["content_id"]: part["section"]
+        for part in message.get("parts") or []
+        if part.get("content_id")
+    }
+    if not value or not images:
+        return value
+
+    def replace(match):
+        section = images.get(match.group(3).strip().strip("<>"))
+        if section is None:
+            return match.group(0)
+        url = url_for(
+            "api_get_part",
+            address=address,
+            uid=message["uid"],
+            section=section,
+            folder=message["folder"],
+            inline=1,
+        )
+        return f'{match.group(1)}{match.group(2)}{html.escape(url)}{match.group(2)} loading="lazy"'
+
+    return CID_IMG_RE.sub(replace, value)
+
+
+def fetch_full_message(mail, uid):
+    status, msg_data = mail.uid("fetch", uid, "(RFC822)")
+    if status != "OK" or not msg_data:
+        raise MailError("Message fetch failed.")
+    raw_email = None
+    for part in msg_data:
+        if isinstance(part, tuple) and len(part) > 1:
+            raw_email = part[1]
+            break
+    if not raw_email:
+        raise MailError("Message empty.")
+    parsed = extract_message(raw_email)
+    parsed["size"] = len(raw_email)
+    return parsed
+
+
+def fetch_message(mailbox, uid, folder=None):
+    if not str(uid).isdigit():
+        raise MailError("Invalid UID.")
+    folder_name = normalize_folder(folder)
+    cached = load_cached_body(mailbox["id"], folder_name, uid)
+    if cached is not None and cached["parts"] is not None:
+        return cached
+    with imap_session(mailbox) as mail:
+        folder_name = open_message_folder(mail, mailbox, folder_name)
+        uidvalidity = folder_uidvalidity(mail)
+        if uidvalidity is not None:
+            record_folder_state(mailbox["id"], folder_name, uidvalidity)
+        if cached is not None:
+            structure = fetch_structure(mail, uid)
+            cached["parts"] = attachment_parts(structure_parts(structure)) if structure else []
+            if structure and uidvalidity is not None:
+                store_message_parts(mailbox["id"], folder_name, uidvalidity, uid, cached["parts"])
+            return cached
+        parsed = fetch_message_parts(mail, uid)
+        if parsed is None:
+            parsed = fetch_full_message(mail, uid)
+        parsed["uid"] = uid
+        parsed["folder"] = folder_name
+        parsed["folder_label"] = folder_label(folder_name)
+        if uidvalidity is not None:
+            store_messages(mailbox["id"], folder_name, uidvalidity, [parsed])
+        return parsed
+
+
+def remove_mailbox(address, user_key):
+    with get_db() as conn:
+        if MULTI_USER:
+            row = conn.execute(
+                "SELECT id FROM mailboxes WHERE address = ? AND owner_key = ?",
+                (address, user_key),
+            ).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT id FROM mailboxes WHERE address = ?", (address,)
+            ).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM mailboxes WHERE id = ?", (row["id"],))
+        conn.execute("DELETE FROM mailbox_folders WHERE mailbox_id = ?", (row["id"],))
+        conn.execute("DELETE FROM folder_state WHERE mailbox_id = ?", (row["id"],))
+        conn.execute("DELETE FROM messages WHERE mailbox_id = ?", (row["id"],))
+    IMAP_POOL.drop(address)
+
+
+def message_summary(msg):
+    return {
+        "uid": msg.get("uid"),
+        "subject": msg.get("subject"),
+        "mail_from": msg.get("mail_from"),
+        "mail_to": msg.get("mail_to"),
+        "mail_dt": msg.get("mail_dt"),
+        "mail_ts": msg.get("mail_ts"),
+        "folder": msg.get("folder"),
+        "folder_label": msg.get("folder_label"),
+    }
+
+
+class EventHub:
+    def __init__(self, history):
+        self.cond = threading.Condition()
+        self.last_id = 0
+        self.events = deque(maxlen=history)
+
+    def publish(self, kind, mailbox_id, **data):
+        with self.cond:
+            self.last_id += 1
+            event = {"id": self.last_id, "type": kind, "mailbox_id": mailbox_id, "time": int(time.time())}
+            event.update(data)
+            self.events.append(event)
+            self.cond.notify_all()
+            return event
+
+    def latest(self):
+        with self.cond:
+            return self.last_id
+
+    def wait(self, after_id, timeout, mailbox_ids=None):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                found = [
+                    event
+                    for event in self.events
+                    if event["id"] > after_id
+                    and (mailbox_ids is None or event["mailbox_id"] in mailbox_ids)
+                ]
+                if found:
+                    return found
+                after_id = max(after_id, self.last_id)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self.cond.wait(remaining)
+
+
+EVENTS = EventHub(EVENT_HISTORY)
+
+
+class SyncScheduler:
+    def __init__(self, interval, workers):
+        self.interval = interval
+        self.workers = max(1, workers)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.executor = None
+        self.inflight = set()
+        self.next_due = {}
+        self.last_viewed = {}
+        self.status = {}
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.interval <= 0 or self.running:
+            return
+        self.stop_event.clear()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sync")
+        self.thread = threading.Thread(target=self._loop, name="sync-scheduler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def touch(self, mailbox_id):
+        with self.lock:
+            self.last_viewed[mailbox_id] = time.time()
+
+    def is_fresh(self, mailbox_id):
+        if not self.running:
+            return False
+        with self.lock:
+            entry = self.status.get(mailbox_id)
+            return bool(entry and entry["last_ok"] and entry["last_ok"] >= time.time() - self.interval)
+
+    def last_synced(self, mailbox_id):
+        with self.lock:
+            entry = self.status.get(mailbox_id)
+            return entry["last_ok"] if entry else 0
+
+    def mark_synced(self, mailbox, duration, new=0, error=None):
+        now = time.time()
+        with self.lock:
+            entry = self.status.setdefault(
+                mailbox["id"],
+                {"address": mailbox["address"], "last_ok": 0, "last_error": None, "new": 0},
+            )
+            entry["last_sync"] = int(now)
+            entry["duration_ms"] = round(duration * 1000, 1)
+            if error is None:
+                entry["last_ok"] = int(now)
+                entry["last_error"] = None
+                entry["new"] = new
+                self.next_due[mailbox["id"]] = now + self._jittered(self.interval)
+            else:
+                entry["last_error"] = error
+        EVENTS.publish(
+            "sync",
+            mailbox["id"],
+            synced_at=int(now),
+            duration_ms=round(duration * 1000, 1),
+            new=new,
+            error=error,
+        )
+
+    def snapshot(self, mailbox_ids=None):
+        with self.lock:
+            items = []
+            for mailbox_id, entry in self.status.items():
+                if mailbox_ids is not None and mailbox_id not in mailbox_ids:
+                    continue
+                item = dict(entry)
+                item["next_due"] = int(self.next_due.get(mailbox_id, 0))
+                item["syncing"] = mailbox_id in self.inflight
+                items.append(item)
+            return {
+                "running": self.running,
+                "interval": self.interval,
+                "workers": self.workers,
+                "inflight": len(self.inflight),
+                "mailboxes": sorted(items, key=lambda item: item["address"]),
+            }
+
+    def _jittered(self, seconds):
+        return seconds * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self._dispatch()
+            except Exception as exc:
+                print(f"Sync scheduler error: {exc}")
+            self.stop_event.wait(1)
+
+    def _dispatch(self):
+        with get_db() as conn:
+            mailboxes = conn.execute("SELECT * FROM mailboxes").fetchall()
+        now = time.time()
+        ids = {row["id"] for row in mailboxes}
+        with self.lock:
+            for mailbox_id in list(self.status):
+                if mailbox_id not in ids:
+                    self.status.pop(mailbox_id, None)
+                    self.next_due.pop(mailbox_id, None)
+            for mailbox_id in ids:
+                if mailbox_id not in self.next_due:
+                    self.next_due[mailbox_id] = now + random.uniform(0, SYNC_JITTER * self.interval)
+            due = [
+                row
+                for row in mailboxes
+                if self.next_due[row["id"]] <= now and row["id"] not in self.inflight
+            ]
+            due.sort(
+                key=lambda row: (-self.last_viewed.get(row["id"], 0), self.next_due[row["id"]])
+            )
+            free = self.workers - len(self.inflight)
+            batch = due[:max(0, free)]
+            for row in batch:
+                self.inflight.add(row["id"])
+        for row in batch:
+            self.executor.submit(self._run, row)
+
+    def _run(self, mailbox):
+        started = time.perf_counter()
+        try:
+            new = sync_mailbox(mailbox)
+        except Exception as exc:
+            self.mark_synced(mailbox, time.perf_counter() - started, error=str(exc))
+            with self.lock:
+                self.next_due[mailbox["id"]] = time.time() + self._jittered(self.interval)
+        else:
+            self.mark_synced(mailbox, time.perf_counter() - started, new=new)
+        finally:
+            with self.lock:
+                self.inflight.discard(mailbox["id"])
+
+
+SYNC_SCHEDULER = SyncScheduler(SYNC_INTERVAL, SYNC_WORKERS)
+
+
+def sync_mailbox(mailbox):
+    new = 0
+    with imap_session(mailbox) as mail:
+        for folder in resolve_folders(mailbox, mail)["scan"]:
+            result = sync_folder(mail, mailbox, folder)
+            if result is not None:
+                new += result["new"]
+    return new
+
+
+class IdleWatcher:
+    def __init__(self, connect_workers):
+        self.connect_workers = max(1, connect_workers)
+        self.lock = threading.Lock()
+        self.selector = None
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.connector = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.watches = {}
+        self.pending = []
+        self.exists = {}
+        self.tag_counter = 0
+        self.reconnects = 0
+        self.last_reconcile = 0
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.connector = ThreadPoolExecutor(max_workers=self.connect_workers, thread_name_prefix="idle-connect")
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._loop, name="idle-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self._wakeup()
+
+    def watch_mailbox(self, mailbox):
+        if self.running:
+            self.connector.submit(self._watch_mailbox, dict(mailbox))
+
+    def watching(self, mailbox_id):
+        with self.lock:
+            return any(
+                key[0] == mailbox_id and watch["state"] == "idling"
+                for key, watch in self.watches.items()
+            )
+
+    def stats(self):
+        with self.lock:
+            states = {}
+            for watch in self.watches.values():
+                states[watch["state"]] = states.get(watch["state"], 0) + 1
+            return {
+                "running": self.running,
+                "watches": len(self.watches),
+                "states": states,
+                "reconnects": self.reconnects,
+            }
+
+    def _wakeup(self):
+        try:
+            self.wakeup_w.send(b"x")
+        except OSError:
+            pass
+
+    def _watch_mailbox(self, mailbox):
+        try:
+            folders = resolve_folders(mailbox)["scan"]
+        except Exception as exc:
+            print(f"IDLE folder discovery failed for {mailbox['address']}: {exc}")
+            return
+        for folder in folders:
+            key = (mailbox["id"], folder)
+            with self.lock:
+                if key in self.watches:
+                    continue
+                self.watches[key] = {
+                    "mailbox": mailbox,
+                    "folder": folder,
+                    "state": "connecting",
+                    "mail": None,
+                    "buffer": b"",
+                    "tag": b"",
+                    "since": 0,
+                    "retry_at": 0,
+                    "backoff": 5,
+                }
+            self.connector.submit(self._connect, key)
+
+    def _next_tag(self):
+        with self.lock:
+            self.tag_counter += 1
+            return f"IDLE{self.tag_counter}".encode("ascii")
+
+    def _connect(self, key):
+        with self.lock:
+            watch = self.watches.get(key)
+        if watch is None:
+            return
+        mail = None
+        try:
+            mail = connect_mailbox(watch["mailbox"])
+            if "IDLE" not in mail.capabilities:
+                raise MailError("Server does not support IDLE.")
+            count = select_folder(mail, watch["folder"])
+            if count is None:
+                raise MailError("Mailbox select failed.")
+            tag = self._next_tag()
+            mail.send(tag + b" IDLE\r\n")
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise MailError("Connection closed.")
+                if line.startswith(b"+"):
+                    break
+                if line.startswith(tag):
+                    raise MailError("IDLE rejected.")
+        except Exception as exc:
+            if mail is not None:
+                try:
+                    mail.shutdown()
+                except Exception:
+                    pass
+            self._schedule_retry(key, str(exc))
+            return
+        with self.lock:
+            if key not in self.watches:
+                try:
+                    mail.shutdown()
+                except Exception:
+                    pass
+                return
+            previous = self.exists.get(key)
+            self.exists[key] = count
+            watch.update(mail=mail, tag=tag, buffer=b"", since=time.time(), backoff=5)
+            self.pending.append(key)
+        self._wakeup()
+        if previous is not None and count > previous:
+            EVENTS.publish("exists", key[0], folder=key[1], exists=count)
+            self._sync(watch["mailbox"], key[1])
+
+    def _schedule_retry(self, key, error):
+        with self.lock:
+            watch = self.watches.get(key)
+            if watch is None:
+                return
+            watch["state"] = "waiting"
+            watch["error"] = error
+            watch["mail"] = None
+            watch["retry_at"] = time.time() + watch["backoff"]
+            watch["backoff"] = min(IDLE_RECONNECT_MAX, watch["backoff"] * 2)
+            self.reconnects += 1
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            try:
+                self._tick()
+            except Exception as exc:
+                print(f"IDLE watcher error: {exc}")
+                self.stop_event.wait(1)
+
+    def _tick(self):
+        now = time.time()
+        if now - self.last_reconcile >= IDLE_RECONCILE:
+            self.last_reconcile = now
+            self._reconcile()
+        with self.lock:
+            pending, self.pending = self.pending, []
+            retry = [
+                key
+                for key, watch in self.watches.items()
+                if watch["state"] == "waiting" and watch["retry_at"] <= now
+            ]
+            for key in retry:
+                self.watches[key]["state"] = "connecting"
+        for key in retry:
+            self.connector.submit(self._connect, key)
+        for key in pending:
+            self._register(key)
+        timeout = 5
+        renew = []
+        with self.lock:
+            for key, watch in self.watches.items():
+                if watch["state"] == "idling":
+                    renew_in = watch["since"] + IDLE_RENEW - now
+                    if renew_in <= 0:
+                        watch["state"] = "ending"
+                        renew.append((key, watch))
+                    else:
+                        timeout = min(timeout, renew_in)
+        for key, watch in renew:
+            try:
+                self._send(watch, b"DONE\r\n")
+            except Exception as exc:
+                self._drop(key, retry=True, error=str(exc))
+        for selector_key, _ in self.selector.select(timeout):
+            if selector_key.data is None:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            self._read(selector_key.data)
+
+    def _reconcile(self):
+        with get_db() as conn:
+            mailboxes = conn.execute("SELECT * FROM mailboxes").fetchall()
+        ids = {row["id"] for row in mailboxes}
+        with self.lock:
+            watched = {key[0] for key in self.watches}
+            removed = [key for key in self.watches if key[0] not in ids]
+        for key in removed:
+            self._drop(key)
+        for row in mailboxes:
+            if row["id"] not in watched:
+                self.watch_mailbox(row)
+
+    def _register(self, key):
+        with self.lock:
+            watch = self.watches.get(key)
+            if watch is None or watch["mail"] is None:
+                return
+            watch["state"] = "idling"
+            mail = watch["mail"]
+        mail.sock.setblocking(False)
+        self.selector.register(mail.sock, selectors.EVENT_READ, key)
+        self._read(key, drain_only=True)
+
+    def _drop(self, key, retry=False, error=""):
+        with self.lock:
+            watch = self.watches.get(key) if retry else self.watches.pop(key, None)
+            mail = watch["mail"] if watch else None
+        if mail is not None:
+            try:
+                self.selector.unregister(mail.sock)
+            except (KeyError, ValueError, OSError):
+                pass
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+        if retry:
+            self._schedule_retry(key, error)
+
+    def _send(self, watch, data):
+        sock = watch["mail"].sock
+        sock.settimeout(IMAP_TIMEOUT)
+        try:
+            sock.sendall(data)
+        finally:
+            sock.setblocking(False)
+
+    def _read(self, key, drain_only=False):
+        with self.lock:
+            watch = self.watches.get(key)
+        if watch is None or watch["mail"] is None:
+            return
+        chunks = []
+        try:
+            while True:
+                chunk = watch["mail"].file.read1(65536)
+                if not chunk:
+                    if chunk is not None and not chunks and not drain_only:
+                        raise MailError("Connection closed.")
+                    break
+                chunks.append(chunk)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+        except Exception as exc:
+            self._drop(key, retry=True, error=str(exc))
+            return
+        watch["buffer"] += b"".join(chunks)
+        while b"\r\n" in watch["buffer"]:
+            line, watch["buffer"] = watch["buffer"].split(b"\r\n", 1)
+            try:
+                self._handle_line(key, watch, line)
+            except Exception as exc:
+                self._drop(key, retry=True, error=str(exc))
+                return
+
+    def _handle_line(self, key, watch, line):
+        match = IDLE_EXISTS_RE.match(line)
+        if match:
+            count = int(match.group(1))
+            with self.lock:
+                previous = self.exists.get(key, 0)
+                self.exists[key] = count
+            if count > previous:
+                EVENTS.publish("exists", key[0], folder=key[1], exists=count)
+                self.connector.submit(self._sync, watch["mailbox"], key[1])
+        elif IDLE_EXPUNGE_RE.match(line):
+            with self.lock:
+                if key in self.exists:
+                    self.exists[key] = max(0, self.exists[key] - 1)
+        elif line.startswith(b"* BYE"):
+            raise MailError("Server closed IDLE connection.")
+        elif watch["state"] == "ending" and line.startswith(watch["tag"] + b" "):
+            watch["tag"] = self._next_tag()
+            self._send(watch, watch["tag"] + b" IDLE\r\n")
+            watch["state"] = "starting"
+        elif watch["state"] == "starting" and line.startswith(b"+"):
+            watch["state"] = "idling"
+            watch["since"] = time.time()
+
+    def _sync(self, mailbox, folder):
+        try:
+            with imap_session(mailbox) as mail:
+                sync_folder(mail, mailbox, folder)
+        except Exception as exc:
+            print(f"IDLE sync failed for {mailbox['address']}: {exc}")
+
+
+IDLE_WATCHER = IdleWatcher(IDLE_CONNECT_WORKERS)
+
+
+AGGREGATE_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, AGGREGATE_WORKERS), thread_name_prefix="aggregate")
+
+
+def list_all_messages(mailboxes, limit, meta=None):
+    started = time.perf_counter()
+    task_started = {}
+
+    def run(mailbox):
+        task_started[mailbox["id"]] = time.perf_counter()
+        return list_messages(mailbox, limit)
+
+    futures = {AGGREGATE_EXECUTOR.submit(run, mailbox): mailbox for mailbox in mailboxes}
+    waves = -(-len(mailboxes) // max(1, AGGREGATE_WORKERS))
+    give_up = started + AGGREGATE_TIMEOUT * max(1, waves)
+    running = set(futures)
+    pending = set()
+    while running:
+        now = time.perf_counter()
+        wake = give_up
+        for future in list(running):
+            began = task_started.get(futures[future]["id"])
+            if began is None:
+                deadline = give_up
+                wake = min(wake, now + AGGREGATE_TIMEOUT)
+            else:
+                deadline = began + AGGREGATE_TIMEOUT
+                wake = min(wake, deadline)
+            if now >= deadline:
+                running.discard(future)
+                pending.add(future)
+        if running:
+            wait(running, timeout=max(0, wake - now), return_when=FIRST_COMPLETED)
+            running = {future for future in running if not future.done()}
+    for future in pending:
+        future.cancel()
+    streams = []
+    errors = []
+    for future, mailbox in futures.items():
+        if future in pending:
+            errors.append({"address": mailbox["address"], "error": "Timed out."})
+            continue
+        try:
+            messages = future.result()
+        except Exception as exc:
+            errors.append({"address": mailbox["address"], "error": str(exc) or exc.__class__.__name__})
+            continue
+        for message in messages:
+            message["address"] = mailbox["address"]
+        streams.append(messages)
+    merged = heapq.merge(*streams, key=lambda item: item.get("mail_ts", 0), reverse=True)
+    messages = [message for _, message in zip(range(limit), merged)]
+    if meta is not None:
+        meta["mailboxes"] = len(mailboxes)
+        meta["errors"] = errors
+        meta["partial"] = bool(errors)
+        meta["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return messages, errors
+
+
+def build_share_body(message):
+    if message["body_html"]:
+        return SANITIZE_CACHE.get(message["body_html"])
+    if message["body_text"]:
+        return "<pre>" + html.escape(message["body_text"]) + "</pre>"
+    return "<p>(empty)</p>"
+
+
+def store_share_body(conn, body_html):
+    data = (body_html or "").encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    conn.execute(
+        """
+        INSERT INTO share_bodies (hash, body, size, refcount) VALUES (?, ?, ?, 1)
+        ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+        """,
+        (digest, zlib.compress(data, 6), len(data)),
+    )
+    return digest
+
+
+def release_share_body(conn, digest):
+    if not digest:
+        return
+    conn.execute("UPDATE share_bodies SET refcount = refcount - 1 WHERE hash = ?", (digest,))
+    conn.execute("DELETE FROM share_bodies WHERE hash = ? AND refcount <= 0", (digest,))
+
+
+def load_share_body(conn, share):
+    if not share["body_hash"]:
+        return share["body_html"] or ""
+    row = conn.execute("SELECT body FROM share_bodies WHERE hash = ?", (share["body_hash"],)).fetchone()
+    return zlib.decompress(row["body"]).decode("utf-8") if row else ""
+
+
+def load_share(conn, code, user_key=None):
+    if MULTI_USER and user_key is not None:
+        share = conn.execute(
+            "SELECT * FROM shares WHERE code = ? AND owner_key = ?", (code, user_key)
+        ).fetchone()
+    else:
+        share = conn.execute("SELECT * FROM shares WHERE code = ?", (code,)).fetchone()
+    if share is None:
+        return None
+    payload = {key: share[key] for key in share.keys() if key != "body_hash"}
+    payload["body_html"] = load_share_body(conn, share)
+    return payload
+
+
+def create_share(conn, message, owner_key):
+    code = generate_share_code(conn)
+    conn.execute(
+        """
+        INSERT INTO shares (code, subject, mail_from, mail_to, mail_dt, body_hash, owner_key, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            code,
+            message["subject"],
+            message["mail_from"],
+            message["mail_to"],
+            message["mail_dt"],
+            store_share_body(conn, build_share_body(message)),
+            owner_key,
+            int(time.time()),
+        ),
+    )
+    return code
+
+
+def delete_share_row(conn, code, user_key):
+    if MULTI_USER:
+        share = conn.execute(
+            "SELECT body_hash FROM shares WHERE code = ? AND owner_key = ?", (code, user_key)
+        ).fetchone()
+    else:
+        share = conn.execute("SELECT body_hash FROM shares WHERE code = ?", (code,)).fetchone()
+    if share is None:
+        return
+    conn.execute("DELETE FROM shares WHERE code = ?", (code,))
+    release_share_body(conn, share["body_hash"])
+
+
+def parse_share_cursor(value):
+    created_at, _, code = (value or "").partition(",")
+    if not created_at.strip().isdigit() or not code.strip():
+        raise MailError("Invalid before, use <created_at>,<code>.")
+    return int(created_at), code.strip()
+
+
+def list_shares(conn, user_key, limit, before=None, include_body=False):
+    clauses = []
+    params = []
+    if MULTI_USER:
+        clauses.append("owner_key = ?")
+        params.append(user_key)
+    if before is not None:
+        clauses.append("(created_at, code) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    columns = SHARE_LIST_COLUMNS + (", body_hash, body_html" if include_body else "")
+    rows = conn.execute(
+        f"SELECT {columns} FROM shares {where} ORDER BY created_at DESC, code DESC LIMIT ?",
+        params + [limit + 1],
+    ).fetchall()
+    next_before = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before = f"{rows[-1]['created_at']},{rows[-1]['code']}"
+    shares = []
+    for row in rows:
+        share = {key: row[key] for key in SHARE_LIST_COLUMNS.split(", ")}
+        if include_body:
+            share["body_html"] = load_share_body(conn, row)
+        shares.append(share)
+    return shares, next_before
+
+
+def generate_share_code(conn):
+    alphabet = string.ascii_letters + string.digits
+    for _ in range(20):
+        code = "".join(secrets.choice(alphabet) for _ in range(SHARE_CODE_LEN))
+        if not (any(c.isalpha() for c in code) and any(c.isdigit() for c in code)):
             continue
         exists = conn.execute("SELECT 1 FROM shares WHERE code = ?", (code,)).fetchone()
         if not exists:
@@ -1200,7 +4043,7 @@ def generate_share_code(conn):
 def set_security_headers(response):
     response.headers["Content-Security-Policy"] = (
         "default-src 'none'; "
-        "img-src https: data:; "
+        "img-src 'self' https: data:; "
         "style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; "
         "font-src https://fonts.gstatic.com; "
         "script-src 'self' 'unsafe-inline'; "
@@ -1256,20 +4099,19 @@ def shares_page():
     user_key = require_user()
     if user_key is None:
         return render_login_page("Please login to view shares.")
+    before = None
+    if request.args.get("before"):
+        try:
+            before = parse_share_cursor(request.args["before"])
+        except MailError as exc:
+            flash(str(exc), "error")
     with get_db() as conn:
-        if MULTI_USER:
-            shares = conn.execute(
-                "SELECT * FROM shares WHERE owner_key = ? ORDER BY created_at DESC",
-                (user_key,),
-            ).fetchall()
-        else:
-            shares = conn.execute(
-                "SELECT * FROM shares ORDER BY created_at DESC"
-            ).fetchall()
+        shares, next_before = list_shares(conn, user_key, SHARE_PAGE_SIZE, before)
     return render_page(
         "Shares - MailAdmin",
         SHARES_TEMPLATE,
         shares=shares,
+        next_before=next_before,
         format_ts=format_ts,
         active="shares",
     )
@@ -1310,6 +4152,36 @@ def api_health():
     return api_ok({"status": "ok", "time": int(time.time()), "multi_user": MULTI_USER})
 
 
+@APP.get("/api/stats")
+def api_stats():
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    return api_ok(
+        {
+            "imap_pool": IMAP_POOL.stats(),
+            "token_cache": TOKEN_CACHE.stats(),
+            "idle": IDLE_WATCHER.stats(),
+            "sanitize_cache": SANITIZE_CACHE.stats(),
+        }
+    )
+
+
+@APP.get("/api/sync")
+def api_sync_status():
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    with get_db() as conn:
+        if MULTI_USER:
+            rows = conn.execute(
+                "SELECT id FROM mailboxes WHERE owner_key = ?", (user_key,)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT id FROM mailboxes").fetchall()
+    return api_ok(SYNC_SCHEDULER.snapshot({row["id"] for row in rows}))
+
+
 @APP.post("/api/auth/login")
 def api_auth_login():
     data = request.get_json(silent=True) or {}
@@ -1454,6 +4326,7 @@ def api_import_mailboxes():
                         address,
                     ),
                 )
+                IMAP_POOL.drop(address)
             else:
                 conn.execute(
                     """
@@ -1484,14 +4357,7 @@ def api_delete_mailbox(address):
     user_key = require_user(api=True)
     if isinstance(user_key, tuple):
         return user_key
-    with get_db() as conn:
-        if MULTI_USER:
-            conn.execute(
-                "DELETE FROM mailboxes WHERE address = ? AND owner_key = ?",
-                (address, user_key),
-            )
-        else:
-            conn.execute("DELETE FROM mailboxes WHERE address = ?", (address,))
+    remove_mailbox(address, user_key)
     return api_ok({"deleted": address})
 
 
@@ -1518,25 +4384,214 @@ def api_list_messages(address):
             ).fetchone()
     if not mailbox:
         return api_error("Mailbox not found.", status=404)
+    cursor = request.args.get("cursor", "").strip()
+    bounds = None
+    try:
+        filters = parse_message_filters(request.args)
+        if cursor:
+            bounds = decode_cursor(cursor)
+    except MailError as exc:
+        return api_error(str(exc), status=400)
+    if filters and bounds:
+        return api_error("cursor cannot be combined with filters.", status=400)
+    stream = request.args.get("stream", "").strip().lower()
+    accept = request.headers.get("Accept", "")
+    sse = stream == "sse" or "text/event-stream" in accept
+    if sse or stream in ("1", "true", "ndjson") or "application/x-ndjson" in accept:
+
+        def produce(put):
+            def emit(folder_messages):
+                for msg in folder_messages:
+                    put({"type": "message", **message_summary(msg)})
+
+            meta = {}
+            if filters:
+                messages = filter_messages(mailbox, filters, limit, meta=meta)
+                emit(messages)
+            elif bounds:
+                messages = page_messages(mailbox, bounds, limit, meta=meta)
+                emit(messages)
+            else:
+                messages = list_messages(mailbox, limit, meta=meta, emit=emit)
+            put(
+                {
+                    "type": "done",
+                    "order": [[msg["folder"], msg["uid"]] for msg in messages],
+                    "meta": meta,
+                }
+            )
+
+        return stream_response(produce, sse)
+    meta = {}
     try:
-        messages = list_messages(mailbox, limit)
+        if filters:
+            messages = filter_messages(mailbox, filters, limit, meta=meta)
+        elif bounds:
+            messages = page_messages(mailbox, bounds, limit, meta=meta)
+        else:
+            messages = list_messages(mailbox, limit, meta=meta)
     except MailError as exc:
         return api_error(str(exc), status=500)
+    payload = [message_summary(msg) for msg in messages]
+    return api_ok(payload, meta=meta)
+
+
+@APP.get("/api/search")
+def api_search():
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    query = request.args.get("q", "").strip()
+    if not query:
+        return api_error("Missing q.", status=400)
+    limit_raw = request.args.get("limit", str(DEFAULT_LIMIT))
+    try:
+        limit = int(limit_raw)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    limit = max(1, min(MAX_LIMIT, limit))
+    address = request.args.get("mailbox", "").strip() or None
+    started = time.perf_counter()
+    try:
+        results = search_messages(query, user_key, address, limit)
+    except sqlite3.OperationalError:
+        return api_error("Invalid search query.", status=400)
+    payload = []
+    for msg in results:
+        item = message_summary(msg)
+        item["address"] = msg["address"]
+        item["snippet"] = msg["snippet"]
+        payload.append(item)
+    meta = {"took_ms": round((time.perf_counter() - started) * 1000, 1)}
+    return api_ok(payload, meta=meta)
+
+
+@APP.get("/api/messages")
+def api_list_all_messages():
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    limit_raw = request.args.get("limit", str(DEFAULT_LIMIT))
+    try:
+        limit = int(limit_raw)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    limit = max(1, min(MAX_LIMIT, limit))
+    with get_db() as conn:
+        if MULTI_USER:
+            mailboxes = conn.execute(
+                "SELECT * FROM mailboxes WHERE owner_key = ?", (user_key,)
+            ).fetchall()
+        else:
+            mailboxes = conn.execute("SELECT * FROM mailboxes").fetchall()
+    meta = {}
+    messages, _ = list_all_messages(mailboxes, limit, meta=meta)
     payload = []
     for msg in messages:
-        payload.append(
-            {
-                "uid": msg.get("uid"),
-                "subject": msg.get("subject"),
-                "mail_from": msg.get("mail_from"),
-                "mail_to": msg.get("mail_to"),
-                "mail_dt": msg.get("mail_dt"),
-                "mail_ts": msg.get("mail_ts"),
-                "folder": msg.get("folder"),
-                "folder_label": msg.get("folder_label"),
-            }
-        )
-    return api_ok(payload)
+        item = message_summary(msg)
+        item["address"] = msg["address"]
+        payload.append(item)
+    return api_ok(payload, meta=meta)
+
+
+@APP.get("/api/events")
+def api_events():
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    with get_db() as conn:
+        if MULTI_USER:
+            rows = conn.execute(
+                "SELECT id, address FROM mailboxes WHERE owner_key = ?", (user_key,)
+            ).fetchall()
+        else:
+            rows = conn.execute("SELECT id, address FROM mailboxes").fetchall()
+    addresses = {row["id"]: row["address"] for row in rows}
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("after", "")
+    after = int(last_id) if last_id.strip().isdigit() else EVENTS.latest()
+
+    def generate():
+        last = after
+        yield "retry: 3000\n\n"
+        while True:
+            events = EVENTS.wait(last, EVENT_KEEPALIVE, set(addresses))
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                last = event["id"]
+                payload = dict(event, address=addresses[event["mailbox_id"]])
+                data = json.dumps(payload, ensure_ascii=False)
+                yield f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@APP.get("/api/mailboxes/<path:address>/messages/wait")
+def api_wait_message(address):
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    try:
+        since = int(request.args.get("since") or time.time() - WAIT_LOOKBACK)
+        timeout = int(request.args.get("timeout") or WAIT_DEFAULT_TIMEOUT)
+    except ValueError:
+        return api_error("since and timeout must be integers.", status=400)
+    timeout = max(1, min(WAIT_MAX_TIMEOUT, timeout))
+    sender = (request.args.get("from") or "").strip()
+    subject_re = None
+    if request.args.get("subject_re"):
+        pattern = request.args["subject_re"]
+        if len(pattern) > WAIT_PATTERN_MAX:
+            return api_error(f"subject_re must be at most {WAIT_PATTERN_MAX} characters.", status=400)
+        if NESTED_QUANTIFIER_RE.search(pattern):
+            return api_error("subject_re must not repeat a quantified group.", status=400)
+        try:
+            subject_re = re.compile(pattern, re.IGNORECASE)
+        except re.error as exc:
+            return api_error(f"Invalid subject_re: {exc}", status=400)
+    with get_db() as conn:
+        if MULTI_USER:
+            mailbox = conn.execute(
+                "SELECT * FROM mailboxes WHERE address = ? AND owner_key = ?",
+                (address, user_key),
+            ).fetchone()
+        else:
+            mailbox = conn.execute(
+                "SELECT * FROM mailboxes WHERE address = ?", (address,)
+            ).fetchone()
+    if not mailbox:
+        return api_error("Mailbox not found.", status=404)
+
+    started = time.time()
+    deadline = started + timeout
+    after = EVENTS.latest()
+    while True:
+        pushed = IDLE_WATCHER.watching(mailbox["id"])
+        if not pushed:
+            try:
+                sync_mailbox(mailbox)
+            except MailError as exc:
+                return api_error(str(exc), status=500)
+            except (imaplib.IMAP4.error, OSError) as exc:
+                return api_error(f"Mailbox sync failed: {exc}", status=500)
+        match = find_stored_match(mailbox["id"], since, sender, subject_re)
+        if match is not None:
+            return api_ok(
+                message_summary(match),
+                meta={"timed_out": False, "waited": round(time.time() - started, 1)},
+            )
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return api_ok(None, meta={"timed_out": True, "waited": round(time.time() - started, 1)})
+        wait_for = remaining if pushed else min(WAIT_POLL_INTERVAL, remaining)
+        events = EVENTS.wait(after, wait_for, {mailbox["id"]})
+        if events:
+            after = events[-1]["id"]
 
 
 @APP.get("/api/mailboxes/<path:address>/message/<uid>")
@@ -1561,10 +4616,49 @@ def api_get_message(address, uid):
         message = fetch_message(mailbox, uid, folder=folder)
     except MailError as exc:
         return api_error(str(exc), status=500)
-    message["safe_body_html"] = sanitize_html(message["body_html"])
+    message["safe_body_html"] = link_inline_images(
+        SANITIZE_CACHE.get(message["body_html"]), mailbox["address"], message
+    )
     return api_ok(message)
 
 
+@APP.get("/api/mailboxes/<path:address>/message/<uid>/part/<section>")
+def api_get_part(address, uid, section):
+    user_key = require_user(api=True)
+    if isinstance(user_key, tuple):
+        return user_key
+    with get_db() as conn:
+        if MULTI_USER:
+            mailbox = conn.execute(
+                "SELECT * FROM mailboxes WHERE address = ? AND owner_key = ?",
+                (address, user_key),
+            ).fetchone()
+        else:
+            mailbox = conn.execute(
+                "SELECT * FROM mailboxes WHERE address = ?", (address,)
+            ).fetchone()
+    if not mailbox:
+        return api_error("Mailbox not found.", status=404)
+    try:
+        folder_name, part = find_message_part(
+            mailbox, uid, section, folder=request.args.get("folder")
+        )
+    except MailError as exc:
+        return api_error(str(exc), status=500)
+    inline = request.args.get("inline") == "1" and part["content_type"] in INLINE_IMAGE_TYPES
+    filename = part["filename"] or f"part-{section}"
+    disposition = "inline" if inline else "attachment"
+    quoted = quote(filename, safe="")
+    return Response(
+        open_part_stream(mailbox, uid, folder_name, part),
+        mimetype=part["content_type"] if inline else "application/octet-stream",
+        headers={
+            "Content-Disposition": f"{disposition}; filename*=UTF-8''{quoted}",
+            "Cache-Control": "private, max-age=3600",
+        },
+    )
+
+
 @APP.post("/api/mailboxes/<path:address>/message/<uid>/share")
 def api_share_message(address, uid):
     user_key = require_user(api=True)
@@ -1589,23 +4683,7 @@ def api_share_message(address, uid):
         return api_error(str(exc), status=500)
 
     with get_db() as conn:
-        code = generate_share_code(conn)
-        conn.execute(
-            """
-            INSERT INTO shares (code, subject, mail_from, mail_to, mail_dt, body_html, owner_key, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                code,
-                message["subject"],
-                message["mail_from"],
-                message["mail_to"],
-                message["mail_dt"],
-                build_share_body(message),
-                user_key if MULTI_USER else "",
-                int(time.time()),
-            ),
-        )
+        code = create_share(conn, message, user_key if MULTI_USER else "")
 
     share_url = request.host_url.rstrip("/") + url_for("view_share", code=code)
     return api_ok({"code": code, "url": share_url})
@@ -1616,18 +4694,22 @@ def api_list_shares():
     user_key = require_user(api=True)
     if isinstance(user_key, tuple):
         return user_key
+    limit_raw = request.args.get("limit", str(SHARE_PAGE_SIZE))
+    try:
+        limit = int(limit_raw)
+    except ValueError:
+        limit = SHARE_PAGE_SIZE
+    limit = max(1, min(SHARE_PAGE_MAX, limit))
+    before = None
+    if request.args.get("before"):
+        try:
+            before = parse_share_cursor(request.args["before"])
+        except MailError as exc:
+            return api_error(str(exc), status=400)
+    include_body = "body" in request.args.get("include", "").split(",")
     with get_db() as conn:
-        if MULTI_USER:
-            shares = conn.execute(
-                "SELECT * FROM shares WHERE owner_key = ? ORDER BY created_at DESC",
-                (user_key,),
-            ).fetchall()
-        else:
-            shares = conn.execute(
-                "SELECT * FROM shares ORDER BY created_at DESC"
-            ).fetchall()
-    payload = [row_to_dict(row) for row in shares]
-    return api_ok(payload)
+        shares, next_before = list_shares(conn, user_key, limit, before, include_body)
+    return api_ok(shares, meta={"next_before": next_before})
 
 
 @APP.get("/api/shares/<code>")
@@ -1636,18 +4718,10 @@ def api_get_share(code):
     if isinstance(user_key, tuple):
         return user_key
     with get_db() as conn:
-        if MULTI_USER:
-            share = conn.execute(
-                "SELECT * FROM shares WHERE code = ? AND owner_key = ?",
-                (code, user_key),
-            ).fetchone()
-        else:
-            share = conn.execute(
-                "SELECT * FROM shares WHERE code = ?", (code,)
-            ).fetchone()
+        share = load_share(conn, code, user_key)
     if not share:
         return api_error("Share not found.", status=404)
-    return api_ok(row_to_dict(share))
+    return api_ok(share)
 
 
 @APP.delete("/api/shares/<code>")
@@ -1656,13 +4730,7 @@ def api_delete_share(code):
     if isinstance(user_key, tuple):
         return user_key
     with get_db() as conn:
-        if MULTI_USER:
-            conn.execute(
-                "DELETE FROM shares WHERE code = ? AND owner_key = ?",
-                (code, user_key),
-            )
-        else:
-            conn.execute("DELETE FROM shares WHERE code = ?", (code,))
+        delete_share_row(conn, code, user_key)
     return api_ok({"deleted": code})
 
 
@@ -1712,6 +4780,7 @@ def import_mailboxes():
                         address,
                     ),
                 )
+                IMAP_POOL.drop(address)
             else:
                 conn.execute(
                     """
@@ -1738,14 +4807,7 @@ def delete_mailbox(address):
     user_key = require_user()
     if user_key is None:
         return render_login_page("Please login to delete mailboxes.")
-    with get_db() as conn:
-        if MULTI_USER:
-            conn.execute(
-                "DELETE FROM mailboxes WHERE address = ? AND owner_key = ?",
-                (address, user_key),
-            )
-        else:
-            conn.execute("DELETE FROM mailboxes WHERE address = ?", (address,))
+    remove_mailbox(address, user_key)
     flash("Mailbox deleted.", "success")
     return redirect(url_for("index"))
 
@@ -1777,8 +4839,13 @@ def view_mailbox(address):
 
     error = None
     messages = []
+    meta = {}
+    cursor = request.args.get("cursor", "").strip()
     try:
-        messages = list_messages(mailbox, limit)
+        if cursor:
+            messages = page_messages(mailbox, decode_cursor(cursor), limit, meta=meta)
+        else:
+            messages = list_messages(mailbox, limit, meta=meta)
     except MailError as exc:
         error = str(exc)
 
@@ -1788,12 +4855,82 @@ def view_mailbox(address):
         mailbox=mailbox,
         messages=messages,
         error=error,
+        next_cursor=meta.get("next_cursor"),
+        live=not cursor,
         limit=limit,
         max_limit=MAX_LIMIT,
         active="mailboxes",
     )
 
 
+@APP.route("/search")
+def search_page():
+    user_key = require_user()
+    if user_key is None:
+        return render_login_page("Please login to search mail.")
+    query = request.args.get("q", "").strip()
+    address = request.args.get("mailbox", "").strip()
+    with get_db() as conn:
+        if MULTI_USER:
+            mailboxes = conn.execute(
+                "SELECT address FROM mailboxes WHERE owner_key = ? ORDER BY address", (user_key,)
+            ).fetchall()
+        else:
+            mailboxes = conn.execute("SELECT address FROM mailboxes ORDER BY address").fetchall()
+    results = []
+    error = None
+    took_ms = None
+    if query:
+        started = time.perf_counter()
+        try:
+            results = search_messages(query, user_key, address or None, MAX_LIMIT)
+        except sqlite3.OperationalError:
+            error = "Invalid search query."
+        took_ms = round((time.perf_counter() - started) * 1000, 1)
+    return render_page(
+        "Search - MailAdmin",
+        SEARCH_TEMPLATE,
+        results=results,
+        mailboxes=mailboxes,
+        mailbox=address,
+        search_query=query,
+        error=error,
+        took_ms=took_ms,
+        active="search",
+    )
+
+
+@APP.route("/messages")
+def all_mail_page():
+    user_key = require_user()
+    if user_key is None:
+        return render_login_page("Please login to view mailboxes.")
+    limit_raw = request.args.get("limit", str(DEFAULT_LIMIT))
+    try:
+        limit = int(limit_raw)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    limit = max(1, min(MAX_LIMIT, limit))
+    with get_db() as conn:
+        if MULTI_USER:
+            mailboxes = conn.execute(
+                "SELECT * FROM mailboxes WHERE owner_key = ?", (user_key,)
+            ).fetchall()
+        else:
+            mailboxes = conn.execute("SELECT * FROM mailboxes").fetchall()
+    messages, errors = list_all_messages(mailboxes, limit)
+    return render_page(
+        "All mail - MailAdmin",
+        ALL_MAIL_TEMPLATE,
+        messages=messages,
+        errors=errors,
+        mailbox_count=len(mailboxes),
+        limit=limit,
+        max_limit=MAX_LIMIT,
+        active="all",
+    )
+
+
 @APP.route("/mailbox/<path:address>/message/<uid>")
 def view_message(address, uid):
     user_key = require_user()
@@ -1819,7 +4956,9 @@ def view_message(address, uid):
         flash(str(exc), "error")
         return redirect(url_for("view_mailbox", address=address))
 
-    message["safe_body_html"] = sanitize_html(message["body_html"])
+    message["safe_body_html"] = link_inline_images(
+        SANITIZE_CACHE.get(message["body_html"]), mailbox["address"], message
+    )
     return render_page(
         f"Message - {mailbox['address']}",
         MESSAGE_TEMPLATE,
@@ -1855,23 +4994,7 @@ def share_message(address, uid):
         return redirect(url_for("view_mailbox", address=address))
 
     with get_db() as conn:
-        code = generate_share_code(conn)
-        conn.execute(
-            """
-            INSERT INTO shares (code, subject, mail_from, mail_to, mail_dt, body_html, owner_key, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                code,
-                message["subject"],
-                message["mail_from"],
-                message["mail_to"],
-                message["mail_dt"],
-                build_share_body(message),
-                user_key if MULTI_USER else "",
-                int(time.time()),
-            ),
-        )
+        code = create_share(conn, message, user_key if MULTI_USER else "")
 
     flash("Share link created.", "success")
     return redirect(url_for("view_share", code=code))
@@ -1880,9 +5003,7 @@ def share_message(address, uid):
 @APP.route("/share/<code>")
 def view_share(code):
     with get_db() as conn:
-        share = conn.execute(
-            "SELECT * FROM shares WHERE code = ?", (code,)
-        ).fetchone()
+        share = load_share(conn, code)
     if not share:
         abort(404)
     return render_page(
@@ -1899,13 +5020,7 @@ def delete_share(code):
     if user_key is None:
         return render_login_page("Please login to manage shares.")
     with get_db() as conn:
-        if MULTI_USER:
-            conn.execute(
-                "DELETE FROM shares WHERE code = ? AND owner_key = ?",
-                (code, user_key),
-            )
-        else:
-            conn.execute("DELETE FROM shares WHERE code = ?", (code,))
+        delete_share_row(conn, code, user_key)
     flash("Share revoked.", "success")
     return redirect(url_for("index"))
 
@@ -1922,6 +5037,9 @@ def main():
         print(f"Port {port} is already in use. Set MAILADMIN_PORT to another value.")
         sys.exit(1)
     maybe_open_browser(port)
+    SYNC_SCHEDULER.start()
+    if IDLE_ENABLED:
+        IDLE_WATCHER.start()
     APP.run(host=host, port=port, debug=False)
 
 
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from server import sanitize_html
+
+
+class SanitizeHtmlTest(unittest.TestCase):
+    def assertNoMarkup(self, value, fragment):
+        self.assertNotIn(fragment, sanitize_html(value))
+
+    def test_keeps_plain_markup(self):
+        value = '<p class="x">Hello <b>world</b></p><img src="https://cdn.example.com/a.png" alt="A">'
+        self.assertEqual(sanitize_html(value), value)
+
+    def test_drops_script_and_base(self):
+        self.assertEqual(sanitize_html("<p>a<script>alert(1)</script>b</p>"), "<p>ab</p>")
+        self.assertEqual(sanitize_html('<base href="https://evil.example/">x'), "x")
+
+    def test_drops_event_handlers(self):
+        self.assertEqual(sanitize_html("<img src=x onerror = alert(1)>"), '<img src="x">')
+        self.assertEqual(sanitize_html('<svg onload="alert(1)"></svg>'), "<svg></svg>")
+
+    def test_drops_script_urls(self):
+        self.assertEqual(sanitize_html('<a href="javascript:alert(1)">x</a>'), "<a>x</a>")
+        self.assertEqual(sanitize_html('<a href=" java\tscript:alert(1)">x</a>'), "<a>x</a>")
+        self.assertEqual(sanitize_html('<a href="&#106;avascript:alert(1)">x</a>'), "<a>x</a>")
+        self.assertEqual(sanitize_html('<a href="VBScript:msgbox(1)">x</a>'), "<a>x</a>")
+        self.assertEqual(
+            sanitize_html('<form><button formaction="javascript:alert(1)">x</button></form>'),
+            "<form><button>x</button></form>",
+        )
+        self.assertEqual(
+            sanitize_html('<svg><a xlink:href="javascript:alert(1)"><text>x</text></a></svg>'),
+            "<svg><a><text>x</text></a></svg>",
+        )
+
+    def test_drops_script_urls_in_svg_animation(self):
+        self.assertEqual(
+            sanitize_html('<animate attributeName="href" values="javascript:alert(1)">'),
+            '<animate attributename="href">',
+        )
+        self.assertEqual(
+            sanitize_html('<set attributeName="href" to="0; javascript:alert(1)">'),
+            '<set attributename="href">',
+        )
+
+    def test_keeps_benign_mentions_of_script_schemes(self):
+        value = '<a href="https://x.example/?q=javascript:foo" title="javascript: the good parts">x</a>'
+        self.assertEqual(sanitize_html(value), value)
+        self.assertEqual(sanitize_html('<img src="a.png" alt="vbscript: legacy">'), '<img src="a.png" alt="vbscript: legacy">')
+
+    def test_drops_srcdoc_and_meta_refresh(self):
+        self.assertEqual(sanitize_html('<iframe srcdoc="<script>alert(1)</script>"></iframe>'), "<iframe></iframe>")
+        self.assertEqual(sanitize_html('<meta http-equiv="refresh" content="0;url=javascript:alert(1)">'), "")
+        self.assertEqual(sanitize_html('<meta charset="utf-8">'), '<meta charset="utf-8">')
+
+    def test_style_cannot_open_markup_in_foreign_content(self):
+        self.assertNoMarkup("<svg><style><img src=x onerror=alert(1)></style></svg>", "<img")
+        self.assertNoMarkup("<math><style><img src=x onerror=alert(1)></style></math>", "<img")
+        self.assertEqual(sanitize_html("<style>a > b { color: red }</style>"), "<style>a > b { color: red }</style>")
+
+    def test_attribute_values_cannot_break_out(self):
+        self.assertNoMarkup('<noscript><p title="</noscript><img src=x onerror=alert(1)>"></noscript>', "<img")
+        self.assertNoMarkup("<svg><![CDATA[</svg><img src=x onerror=alert(1)>]]></svg>", "<img")
+
+    def test_drops_comments(self):
+        self.assertEqual(sanitize_html("a<!--<img src=x onerror=alert(1)>-->b"), "ab")
+
+    def test_escapes_unclosed_markup(self):
+        self.assertEqual(sanitize_html("<p>x<!-- open"), "<p>x&lt;!-- open")
+        self.assertEqual(sanitize_html("a <b and <i"), "a &lt;b and &lt;i")
+
+
+if __name__ == "__main__":
+    unittest.main()